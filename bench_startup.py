@@ -0,0 +1,64 @@
+#!/usr/bin/env python2
+"""
+Benchmark the startup time of sitegen.py, so that slow imports do not
+creep back into the CLI
+"""
+
+import os
+import sys
+import time
+import subprocess as sp
+
+SITEGEN = os.path.join( os.path.dirname( os.path.abspath( __file__ ) ),
+        "sitegen.py" )
+# Modules that must only be imported when they are needed
+LAZY = [ "git", "pdt" ]
+
+def best_time( cmd, runs ):
+    """Best wall time of running cmd over runs"""
+    devnull = open( os.devnull, "w" )
+    best = None
+    for _ in range( runs ):
+        start = time.time()
+        sp.check_call( cmd, stdout = devnull )
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def eager_modules():
+    """Modules in LAZY that importing sitegen loads"""
+    cmd = "import sys, sitegen; print ' '.join( m for m in %r if m in " \
+            "sys.modules )" % LAZY
+    return sp.check_output( [ sys.executable, "-c", cmd ],
+            cwd = os.path.dirname( SITEGEN ) ).split()
+
+def main( runs, limit ):
+    """Benchmark entry point; returns the exit status"""
+    base = best_time( [ sys.executable, "-c", "pass" ], runs )
+    cli = best_time( [ sys.executable, SITEGEN, "--help" ], runs )
+    print "interpreter: %.3fs, sitegen --help: %.3fs, overhead: %.3fs" % (
+            base, cli, cli - base )
+
+    status = 0
+    if cli - base > limit:
+        print "FAIL: startup overhead is above %.3fs" % limit
+        status = 1
+    eager = eager_modules()
+    if eager:
+        print "FAIL: imported at startup: %s" % ", ".join( eager )
+        status = 1
+    return status
+
+if __name__ == "__main__":
+    import argparse
+
+    PARSER = argparse.ArgumentParser( description =
+            "Benchmark sitegen startup time" )
+    PARSER.add_argument( "-n", dest="runs", type=int, default=10,
+            help="Number of runs; the best one is kept" )
+    PARSER.add_argument( "--limit", dest="limit", type=float, default=0.1,
+            help="Maximum startup overhead over the interpreter, in seconds" )
+    ARGS = PARSER.parse_args()
+
+    sys.exit( main( ARGS.runs, ARGS.limit ) )
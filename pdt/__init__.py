@@ -26,7 +26,7 @@ import email.utils
 from . import pdt_locales
 
 
-log = logging.getLogger()
+log = logging.getLogger(__name__)
 echoHandler   = logging.StreamHandler()
 echoFormatter = logging.Formatter('%(levelname)-8s %(message)s')
 log.addHandler(echoHandler)
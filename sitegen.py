@@ -4,18 +4,49 @@ sitegen.py is a static site generator for arun.chagantys.org
 """
 
 import os
-import git
+import re
+import cgi
 import time
-import string
+import json
+import fcntl
+import mmap
+import shutil
+import sqlite3
+import hashlib
+import urllib
+import urlparse
 import mimetypes
+import Queue
+import thread
 import logging
+import logging.handlers
+import threading
+import contextlib
 import subprocess as sp
 import ConfigParser as CP
 import itertools as it
+import multiprocessing as mp
+from multiprocessing.pool import ThreadPool
 PANDOC_EXTN = ".md"
 
-import pdt
-cal = pdt.Calendar() # Using PDT for robust date parsing.
+# GitPython and PDT are slow to import, so they are only loaded when needed
+git = None
+cal = None
+
+def open_repo( path ):
+    """Open the git repository at path, importing GitPython"""
+    global git
+    if git is None:
+        import git
+    return git.Repo( path )
+
+def calendar():
+    """Using PDT for robust date parsing; created on first use"""
+    global cal
+    if cal is None:
+        import pdt
+        cal = pdt.Calendar()
+    return cal
 
 pexists = os.path.exists
 pjoin = os.path.join
@@ -24,6 +55,42 @@ basename = os.path.basename
 
 mimetypes.add_type( "text/markdown", PANDOC_EXTN )
 
+# Links to check: anything in a href or src attribute, sans fragment/query
+LINK_RE = re.compile( r'''(?:href|src)\s*=\s*["']([^"'#?]*)''', re.I )
+
+def target_name( path ):
+    """Name of the published file for a source path"""
+    if path.endswith( PANDOC_EXTN ):
+        return path[:-len(PANDOC_EXTN)] + ".html"
+    else:
+        return path
+
+def parse_header( lines ):
+    """Parse the leading % block of a pandoc file from an iterable of lines,
+    stopping at the first line after it. Returns the title, the list of
+    authors, the date, and a dict of the "Key: value" fields after them,
+    with lower case keys. Like pandoc, a field continues on lines that start
+    with a space. A file without the block is titled by its first line."""
+    fields = []
+    for line in lines:
+        if line.startswith( "%" ):
+            fields.append( line[1:].strip() )
+        elif fields and line[:1] in ( " ", "\t" ) and line.strip():
+            fields[-1] = ( fields[-1] + " " + line.strip() ).strip()
+        else:
+            if not fields:
+                fields.append( line.strip() )
+            break
+    title, authors, date = ( fields + [ "" ] * 3 )[:3]
+    authors = [ author.strip() for author in re.split( "[;,]", authors )
+            if author.strip() ]
+    headers = {}
+    for field in fields[3:]:
+        key, sep, value = field.partition( ":" )
+        if sep:
+            headers[ key.strip().lower() ] = value.strip()
+    return title, authors, date, headers
+
 def get_date( fmts, data ):
     """Try to get the date by sequentially matching patterns"""
     # First try strptime
@@ -39,7 +106,7 @@ def get_date( fmts, data ):
 
     # Then try PDT
     try:
-        return time.struct_time( cal.parseDateText( data ) )
+        return time.struct_time( calendar().parseDateText( data ) )
     except AttributeError:
         pass
     except KeyError:
@@ -47,6 +114,574 @@ def get_date( fmts, data ):
 
     raise ValueError
 
+def git_hash( path, chunk = 1024 * 1024 ):
+    """Hex SHA of the file at path as a git blob. The file is mapped and
+    hashed in chunks, so large assets are never read into memory."""
+    size = os.path.getsize( path )
+    sha = hashlib.sha1( "blob %d\0" % size )
+    if size == 0:
+        return sha.hexdigest()
+    fd = open( path, "rb" )
+    buf = mmap.mmap( fd.fileno(), 0, access = mmap.ACCESS_READ )
+    try:
+        # hashlib releases the GIL on large updates, so threads can hash
+        # several files at once
+        for offset in xrange( 0, len( buf ), chunk ):
+            sha.update( buffer( buf, offset, chunk ) )
+    finally:
+        buf.close()
+        fd.close()
+    return sha.hexdigest()
+
+def tmpname( path ):
+    """Temporary name to write path to before renaming it, unique to the
+    process and thread so shared stores can be written concurrently"""
+    return "%s.%d.%d.tmp" % ( path, os.getpid(), thread.get_ident() )
+
+@contextlib.contextmanager
+def locked( path, exclusive = True ):
+    """Hold an exclusive or shared flock on the file at path"""
+    if not pexists( dirname( path ) ):
+        os.makedirs( dirname( path ) )
+    fd = open( path, "a" )
+    try:
+        fcntl.flock( fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH )
+        yield
+    finally:
+        fd.close()
+
+def shard_owner( path, count ):
+    """Shard (out of count) that renders path"""
+    return int( hashlib.md5( path ).hexdigest()[:8], 16 ) % count
+
+def glob_re( pattern ):
+    """Translate a glob over paths into a regex; * and ? do not match /,
+    ** matches anything"""
+    out = []
+    i = 0
+    while i < len( pattern ):
+        c = pattern[i]
+        if pattern.startswith( "**", i ):
+            out.append( ".*" )
+            i += 1
+        elif c == "*":
+            out.append( "[^/]*" )
+        elif c == "?":
+            out.append( "[^/]" )
+        elif c == "[" and pattern.find( "]", i ) > i:
+            j = pattern.find( "]", i )
+            out.append( "[" + pattern[i+1:j].replace( "\\", "\\\\" ) + "]" )
+            i = j
+        else:
+            out.append( re.escape( c ) )
+        i += 1
+    return "".join( out )
+
+class PathMatcher:
+    """Glob rules over repository paths, compiled into a single regex.
+    A pattern ending in / only matches directories; a matched directory
+    also matches everything below it."""
+    def __init__( self, rules ):
+        """rules is a list of (base, pattern), patterns relative to base"""
+        files, dirs = [], []
+        for base, pattern in rules:
+            pattern = pattern.strip()
+            if not pattern:
+                continue
+            regex = glob_re( pjoin( base.strip("/"), pattern.strip("/") ) )
+            if pattern.endswith( "/" ):
+                dirs.append( regex )
+            else:
+                files.append( regex )
+        self.files = files and re.compile( "(?:%s)(?:/|$)" % "|".join( files ) )
+        self.dirs = dirs and re.compile( "(?:%s)(/|$)" % "|".join( dirs ) )
+
+    def match( self, path, isdir = False ):
+        """Check if path (a directory if isdir) is matched"""
+        if self.files and self.files.match( path ):
+            return True
+        if self.dirs:
+            m = self.dirs.match( path )
+            return m is not None and ( isdir or m.group(1) == "/" )
+        return False
+
+class Substituter:
+    """Substitutes $name and ${name} for a fixed set of variables, with the
+    semantics of string.Template.safe_substitute"""
+    CHUNK = 64 * 1024
+
+    def __init__( self, variables ):
+        self.variables = variables
+        names = "|".join( re.escape( name ) for name in
+                sorted( variables, key = len, reverse = True ) )
+        if names:
+            self.pattern = re.compile(
+                    r"\$(?:(\$)|(%s)(?![_a-z0-9])|\{(%s)\})" % (names, names),
+                    re.I )
+        else:
+            self.pattern = re.compile( r"\$(\$)" )
+        # Longest possible match, i.e. ${name}
+        self.tail = max( [ len( name ) for name in variables ] + [0] ) + 3
+
+    def sub( self, buf, used ):
+        """Substitute variables in buf, adding the names replaced to used"""
+        if "$" not in buf:
+            return buf
+        def replace( match ):
+            if match.group(1) is not None:
+                return "$"
+            name = match.group(2) or match.group(3)
+            if name not in self.variables:
+                return match.group(0)
+            used.add( name )
+            return self.variables[ name ]
+        return self.pattern.sub( replace, buf )
+
+    def stream( self, src, dst ):
+        """Copy file src to dst substituting variables, in chunks. Returns
+        the set of variables used"""
+        used = set()
+        carry = ""
+        while True:
+            chunk = src.read( self.CHUNK )
+            if not chunk:
+                dst.write( self.sub( carry, used ) )
+                return used
+            buf = carry + chunk
+            # Hold back a trailing run of $ that could start a match
+            cut = buf.find( "$", max( 0, len( buf ) - self.tail ) )
+            if cut < 0:
+                cut = len( buf )
+            while cut > 0 and buf[cut-1] == "$":
+                cut -= 1
+            dst.write( self.sub( buf[:cut], used ) )
+            carry = buf[cut:]
+
+class QueueHandler( logging.Handler ):
+    """Hands records to a background thread that writes them to handler,
+    so that logging does not block the build on disk writes"""
+    def __init__( self, handler ):
+        logging.Handler.__init__( self )
+        self.handler = handler
+        self.queue = Queue.Queue()
+        self.thread = threading.Thread( target = self.run )
+        self.thread.daemon = True
+        self.thread.start()
+
+    def emit( self, record ):
+        # Format the message now; its arguments could change before the
+        # writer gets to it
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                    record.exc_info )
+            record.exc_info = None
+        self.queue.put( record )
+
+    def run( self ):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                return
+            self.handler.handle( record )
+
+    def close( self ):
+        """Write out queued records and stop the writer"""
+        if self.thread.is_alive():
+            self.queue.put( None )
+            self.thread.join()
+        self.handler.close()
+        logging.Handler.close( self )
+
+def setup_logging( log, path, level, max_bytes, backups ):
+    """Send the records of the logger log only to a size-rotated file at
+    path, through a QueueHandler, so that sites built in one process each
+    keep their own log"""
+    for handler in log.handlers[:]:
+        if isinstance( handler, QueueHandler ):
+            log.removeHandler( handler )
+            handler.close()
+    handler = logging.handlers.RotatingFileHandler( path,
+            maxBytes = max_bytes, backupCount = backups )
+    handler.setFormatter( logging.Formatter( '%(asctime)-15s %(message)s' ) )
+    log.addHandler( QueueHandler( handler ) )
+    log.setLevel( level )
+    log.propagate = False
+
+class Related:
+    """Top k related pages by cosine similarity of TF-IDF vectors. Only the
+    term counts of changed pages are recomputed; any change shifts the IDF
+    weights of every page, so all the neighbours are searched again."""
+    WORD_RE = re.compile( r"[a-z][a-z0-9]{2,}" )
+    BATCH = 256
+
+    def __init__( self, k, state = None ):
+        state = state or {}
+        self.k = k
+        self.tf = state.get( "tf", {} )
+        self.shas = state.get( "shas", {} )
+        self.titles = state.get( "titles", {} )
+        self.related = state.get( "related", {} )
+        self.changed = set()
+        self.removed = set()
+        # Pages whose title changed, which other pages list
+        self.retitled = set()
+
+    def update( self, path, hexsha, text ):
+        """Recount the terms of the page at path"""
+        counts = {}
+        for word in self.WORD_RE.findall( text.lower() ):
+            counts[ word ] = counts.get( word, 0 ) + 1
+        self.tf[ path ] = counts
+        self.shas[ path ] = hexsha
+        title = text.split( "\n", 1 )[0].strip()
+        title = title[1:].strip() if title.startswith( "%" ) else path
+        if self.titles.get( path ) != title:
+            self.retitled.add( path )
+        self.titles[ path ] = title
+        self.changed.add( path )
+        self.removed.discard( path )
+
+    def remove( self, path ):
+        for d in ( self.tf, self.shas, self.titles, self.related ):
+            d.pop( path, None )
+        self.removed.add( path )
+        self.changed.discard( path )
+
+    def vectors( self, paths ):
+        """Row-normalised sparse TF-IDF matrix of paths"""
+        import numpy as np
+        from scipy import sparse
+
+        vocab = {}
+        rows, cols, vals = [], [], []
+        for i, path in enumerate( paths ):
+            for term, n in self.tf[ path ].items():
+                rows.append( i )
+                cols.append( vocab.setdefault( term, len( vocab ) ) )
+                vals.append( n )
+        X = sparse.csr_matrix( ( np.array( vals, dtype=float ),
+            ( rows, cols ) ), shape=( len( paths ), len( vocab ) ) )
+        X.data = 1 + np.log( X.data )
+        df = np.bincount( cols, minlength=len( vocab ) )
+        X = X * sparse.diags( np.log( ( 1.0 + len( paths ) ) / ( 1.0 + df ) )
+                + 1 )
+        norms = np.sqrt( X.multiply( X ).sum( axis=1 ) ).A1
+        norms[ norms == 0 ] = 1
+        return sparse.diags( 1 / norms ) * X
+
+    def compute( self ):
+        """Search the neighbours of every page again if pages changed since
+        the last call. Returns the paths whose related pages, or their
+        titles, changed."""
+        import numpy as np
+
+        if not self.changed and not self.removed:
+            return set()
+        retitled = self.retitled | self.removed
+        self.changed, self.removed, self.retitled = set(), set(), set()
+        paths = sorted( self.tf )
+        if not paths:
+            return set()
+        X = self.vectors( paths )
+        before, self.related = self.related, {}
+
+        for batch in batches( range( len( paths ) ), self.BATCH ):
+            S = ( X[ batch ] * X.T ).toarray()
+            S[ range( len( batch ) ), batch ] = 0
+            # Stable order on rounded scores keeps ties deterministic
+            top = np.argsort( -S.round( 9 ), axis=1,
+                    kind="mergesort" )[ :, :self.k ]
+            for r, i in enumerate( batch ):
+                self.related[ paths[i] ] = [ paths[j] for j in top[r]
+                        if S[r, j] > 0 ]
+
+        return set( path for path, near in self.related.items()
+                if near != before.get( path ) or retitled.intersection( near ) )
+
+    def to_dict( self ):
+        return { "tf": self.tf, "shas": self.shas, "titles": self.titles,
+                "related": self.related }
+
+class Plugin:
+    """Base class of build plugins, listed in the plugins option of [/] as
+    module.Class. Each hook gets a path and text and returns the text
+    transformed; outputs are memoized on cache_key() and the input."""
+    # Name used for timings and memoized outputs; defaults to the class name
+    name = None
+    # Marks the hooks of this class as no-ops
+    _base_plugin = True
+
+    def __init__( self, gen ):
+        self.gen = gen
+
+    def cache_key( self ):
+        """Version and settings of the plugin; changing it invalidates its
+        memoized outputs and the pages rendered with it"""
+        return ""
+
+    def pre_render( self, path, text ):
+        """Transform the markdown of the page at path before pandoc"""
+        return text
+
+    def post_render( self, path, html ):
+        """Transform the html published at path"""
+        return html
+
+    def index( self, base, text ):
+        """Transform the markdown of an index page of the directory base"""
+        return text
+
+def defines_hook( cls, hook ):
+    """Check if the plugin class cls, or one of its bases other than Plugin,
+    defines hook. Plugin is recognized by a marker rather than by identity,
+    since sitegen can be loaded twice: as __main__ and by plugin modules."""
+    if hook in vars( cls ) and not vars( cls ).get( "_base_plugin" ):
+        return True
+    return any( defines_hook( base, hook ) for base in cls.__bases__ )
+
+def load_plugin( spec ):
+    """Import the plugin class named by module.Class"""
+    module, _, name = spec.strip().rpartition( "." )
+    return getattr( __import__( module, fromlist = [ name ] ), name )
+
+class BuildReport:
+    """Counts and stage timings of one build"""
+    def __init__( self, description = None ):
+        self.description = description
+        # Revisions built from and to, if any
+        self.revs = ( None, None )
+        self.start = time.time()
+        self.counts = {}
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    def count( self, key, n = 1 ):
+        with self.lock:
+            self.counts[ key ] = self.counts.get( key, 0 ) + n
+
+    @contextlib.contextmanager
+    def stage( self, name ):
+        """Time the enclosed block as part of stage name"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.stages[ name ] = self.stages.get( name, 0 ) + \
+                        time.time() - start
+
+    def summary( self ):
+        counts = ", ".join( "%d %s" % (n, key)
+                for key, n in sorted( self.counts.items() ) )
+        stages = ", ".join( "%s %.2fs" % (name, t)
+                for name, t in sorted( self.stages.items() ) )
+        return "%.2fs: %s (%s)" % ( time.time() - self.start,
+                counts or "nothing to do", stages )
+
+class Workers:
+    """Thread pool and pandoc slots shared by the sites built in one
+    process, so that at most jobs pandoc processes run at once"""
+    def __init__( self, jobs ):
+        self.jobs = jobs
+        self.slots = threading.BoundedSemaphore( jobs )
+        self._pool = None
+
+    @property
+    def pool( self ):
+        """Thread pool, started on first use"""
+        if self._pool is None:
+            self._pool = ThreadPool( self.jobs )
+        return self._pool
+
+    def call( self, cmd ):
+        """Run cmd once a slot is free; returns its exit status"""
+        with self.slots:
+            return sp.call( cmd )
+
+class Journal:
+    """Append-only record of the work items a build has finished, synced to
+    disk in batches, so that an interrupted build can resume. A journal
+    without a path records nothing."""
+    SYNC_EVERY = 64
+
+    def __init__( self, path = None, key = None ):
+        """Open the journal at path; items are only kept from a previous run
+        if it had the same key, e.g. the same from and to revs"""
+        self.path = path
+        self.done = set()
+        self.fd = None
+        self.pending = 0
+        self.lock = threading.Lock()
+        if path is None:
+            return
+        if pexists( path ):
+            lines = open( path ).read().split( "\n" )
+            # The last line is empty, or was cut short by a crash
+            if lines[0] == key:
+                self.done = set( lines[1:-1] )
+        if self.done:
+            self.fd = open( path, "a" )
+            if lines[-1]:
+                self.fd.write( "\n" )
+        else:
+            self.fd = open( path, "w" )
+            self.fd.write( key + "\n" )
+
+    def __contains__( self, item ):
+        return item in self.done
+
+    def __len__( self ):
+        return len( self.done )
+
+    def record( self, item ):
+        """Record that item is finished"""
+        if self.fd is None:
+            return
+        with self.lock:
+            self.fd.write( item + "\n" )
+            self.pending += 1
+            if self.pending >= self.SYNC_EVERY:
+                self.sync()
+
+    def sync( self ):
+        self.fd.flush()
+        os.fsync( self.fd.fileno() )
+        self.pending = 0
+
+    def discard( self ):
+        """Remove the journal once its build has completed"""
+        if self.fd is None:
+            return
+        self.fd.close()
+        self.fd = None
+        os.unlink( self.path )
+
+def batches( items, size ):
+    """Split an iterable into lists of at most size items"""
+    items = iter( items )
+    while True:
+        batch = list( it.islice( items, size ) )
+        if not batch:
+            return
+        yield batch
+
+class BatchStream:
+    """File-like view of one object in the output of git cat-file --batch"""
+    def __init__( self, fd, size ):
+        self.fd = fd
+        self.left = size
+        self.drained = False
+
+    def read( self, n = -1 ):
+        if n < 0 or n > self.left:
+            n = self.left
+        buf = self.fd.read( n )
+        self.left -= len( buf )
+        return buf
+
+    def readline( self ):
+        if not self.left:
+            return ""
+        buf = self.fd.readline( self.left )
+        self.left -= len( buf )
+        return buf
+
+    def drain( self ):
+        """Skip what was not read, and the trailing newline"""
+        if self.drained:
+            return
+        while self.left:
+            self.read( 64 * 1024 )
+        self.fd.read( 1 )
+        self.drained = True
+
+class BlobReader:
+    """Reads objects through one persistent git cat-file --batch process,
+    pipelining the requests for many SHAs"""
+    def __init__( self, git_dir ):
+        self.proc = sp.Popen( [ "git", "--git-dir", git_dir, "cat-file",
+            "--batch" ], stdin = sp.PIPE, stdout = sp.PIPE )
+        self.lock = threading.Lock()
+
+    def request( self, hexshas ):
+        for hexsha in hexshas:
+            self.proc.stdin.write( hexsha + "\n" )
+        self.proc.stdin.flush()
+
+    def response( self ):
+        """Read the next object, or None if it is missing"""
+        header = self.proc.stdout.readline().split()
+        if len( header ) != 3:
+            return None
+        return BatchStream( self.proc.stdout, int( header[2] ) )
+
+    def stream( self, hexshas ):
+        """Yield (hexsha, stream) for every SHA, with all requests sent at
+        once. A stream is only valid until the next one is yielded."""
+        hexshas = list( hexshas )
+        with self.lock:
+            # Write requests from a thread, so neither side of the pipe
+            # blocks on the other
+            writer = threading.Thread( target = self.request,
+                    args = ( hexshas, ) )
+            writer.start()
+            done = 0
+            stream = None
+            try:
+                for hexsha in hexshas:
+                    stream = self.response()
+                    done += 1
+                    yield hexsha, stream
+                    if stream is not None:
+                        stream.drain()
+            finally:
+                # Keep the channel in sync if the caller stopped early
+                if stream is not None:
+                    stream.drain()
+                for _ in range( done, len( hexshas ) ):
+                    stream = self.response()
+                    if stream is not None:
+                        stream.drain()
+                writer.join()
+
+class Entry( object ):
+    """Compact record of a changed file; the blob is only loaded when the
+    entry is compiled"""
+    __slots__ = ( "path", "binsha", "mode" )
+
+    def __init__( self, path, binsha, mode = None ):
+        self.path = path
+        self.binsha = binsha
+        self.mode = mode
+
+    @staticmethod
+    def from_blob( blob ):
+        """Create an entry from a git.Blob"""
+        return Entry( blob.path, blob.binsha, blob.mode )
+
+    @property
+    def hexsha( self ):
+        return self.binsha.encode( "hex" )
+
+    def blob( self, repo ):
+        """Load the git.Blob for this entry"""
+        return git.Blob( repo, self.binsha, self.mode, self.path )
+
+    def __eq__( self, other ):
+        return isinstance( other, Entry ) and (
+                ( self.path, self.binsha ) == ( other.path, other.binsha ) )
+
+    def __ne__( self, other ):
+        return not self == other
+
+    def __hash__( self ):
+        return hash( ( self.path, self.binsha ) )
+
+    def __repr__( self ):
+        return "Entry(%r, %s)" % ( self.path, self.hexsha[:7] )
+
 class ChangeSet:
     """Store set of changes"""
     def __init__( self, rev, modifys, deletes ):
@@ -56,24 +691,37 @@ class ChangeSet:
         self.deletes = set( deletes )
 
     @staticmethod
-    def from_diffiter( rev, diffs ):
-        """Create a change set from a DiffIter"""
-        return ChangeSet( rev,
-                map( lambda d: d.b_blob, it.chain( 
-                    diffs.iter_change_type('A'),
-                    diffs.iter_change_type('M'),
-                    diffs.iter_change_type('R') ) ),
-                map( lambda d: d.a_blob, it.chain( 
-                    diffs.iter_change_type('R'),
-                    diffs.iter_change_type('D') ) )
-                )
+    def from_diffiter( rev, diffs, ignore = None ):
+        """Create a change set from a DiffIter in one pass, without ignored
+        paths"""
+        cs = ChangeSet( rev, (), () )
+        def add( changes, blob ):
+            if ignore is None or not ignore.match( blob.path ):
+                changes.add( Entry.from_blob( blob ) )
+        for d in diffs:
+            if d.new_file:
+                add( cs.modifys, d.b_blob )
+            elif d.deleted_file:
+                add( cs.deletes, d.a_blob )
+            elif d.renamed:
+                add( cs.modifys, d.b_blob )
+                add( cs.deletes, d.a_blob )
+            elif d.a_blob and d.b_blob and d.a_blob != d.b_blob:
+                add( cs.modifys, d.b_blob )
+        return cs
 
     @staticmethod
-    def from_repo( repo ):
-        """Create a basic change set from a Repo"""
-        adds = filter(lambda x: isinstance(x, git.Blob),
-                repo.tree().traverse()) 
-        return ChangeSet( None, adds, [] )
+    def walk( tree, ignore = None ):
+        """Lazily yield (path, binsha) for every blob under tree, depth
+        first, pruning ignored subtrees. Only one directory listing per
+        level is held at a time."""
+        for blob in tree.blobs:
+            if ignore is None or not ignore.match( blob.path ):
+                yield blob.path, blob.binsha
+        for t in tree.trees:
+            if ignore is None or not ignore.match( t.path, True ):
+                for item in ChangeSet.walk( t, ignore ):
+                    yield item
 
     def __len__( self ):
         return len( self.modifys ) + len( self.deletes )
@@ -102,16 +750,132 @@ class ChangeSet:
         self -= cs
         return cs
 
-    def exists( self, path ):
-        """Extract the change set corresponding to this base"""
-        return path in self.modifys or path in self.deletes 
+class Manifest:
+    """Set of paths published in outgoing, with their sources and the
+    hashes of their contents"""
+    def __init__( self, entries = None, hashes = None ):
+        self.entries = dict( entries or {} )
+        self.hashes = dict( hashes or {} )
+        # Paths written or removed in this build
+        self.updated = set()
+        self.removed = set()
+
+    def add( self, path, src ):
+        """Record that path was published from src"""
+        self.entries[ path ] = src
+        self.updated.add( path )
+        self.removed.discard( path )
+
+    def remove( self, path ):
+        """Record that path is no longer published"""
+        self.entries.pop( path, None )
+        self.hashes.pop( path, None )
+        self.removed.add( path )
+        self.updated.discard( path )
+
+    def rehash( self, path, digest ):
+        """Set the hash of path; returns False if it did not change"""
+        if self.hashes.get( path ) == digest:
+            return False
+        self.hashes[ path ] = digest
+        return True
+
+    def delta( self, published ):
+        """Deploy delta from a target holding the published hashes: the
+        paths to upload and delete, and those unchanged"""
+        delta = { "uploaded": {}, "deleted": [], "unchanged": {} }
+        for path, digest in self.hashes.items():
+            if published.get( path ) == digest:
+                delta[ "unchanged" ][ path ] = digest
+            else:
+                delta[ "uploaded" ][ path ] = digest
+        delta[ "deleted" ] = sorted( path for path in published
+                if path not in self.hashes )
+        return delta
+
+    def __contains__( self, path ):
+        return path in self.entries
+
+    def __len__( self ):
+        return len( self.entries )
+
+class LinkIndex:
+    """Forward and reverse index of the links between published pages"""
+    def __init__( self, links = None ):
+        self.links = {}
+        self.reverse = {}
+        for page, targets in (links or {}).items():
+            self.update( page, targets )
+
+    def update( self, page, targets ):
+        """Replace the links of page by targets"""
+        self.drop( page )
+        self.links[ page ] = set( targets )
+        for target in self.links[ page ]:
+            self.reverse.setdefault( target, set() ).add( page )
+
+    def drop( self, page ):
+        """Forget the links of page"""
+        for target in self.links.pop( page, () ):
+            self.reverse[ target ].discard( page )
+            if not self.reverse[ target ]:
+                del self.reverse[ target ]
+
+    def referrers( self, target ):
+        """Pages linking to target"""
+        return self.reverse.get( target, set() )
+
+    def broken( self, manifest ):
+        """List (page, target) for every link that does not resolve"""
+        return sorted( (page, target)
+                for target, pages in self.reverse.items()
+                if target not in manifest
+                for page in pages )
+
+    def to_dict( self ):
+        return dict( (page, sorted( targets ))
+                for page, targets in self.links.items() )
 
 class SiteGenerator:
     """Static Site Generator"""
-    REV_NAME = "current" 
-
-    def __init__(self, conf_path):
-        """Create a site generator with settings in the conf file"""
+    # Build state lives in its own directory of the meta store, apart from
+    # the cached copies of repo files, which may have any name. gc never
+    # evicts it, but for the index state of directories that are gone.
+    STATE_NAME = "state"
+    REV_NAME = pjoin( STATE_NAME, "current" )
+    VARIABLES_NAME = pjoin( STATE_NAME, "variables.json" )
+    STAT_NAME = pjoin( STATE_NAME, "worktree.json" )
+    SHARD_NAME = ".sitegen-shard.json"
+    BATCH_SIZE = 512
+    MANIFEST_NAME = pjoin( STATE_NAME, "manifest.json" )
+    LINKS_NAME = pjoin( STATE_NAME, "links.json" )
+    JOURNAL_NAME = pjoin( STATE_NAME, "journal" )
+    FAILED_NAME = pjoin( STATE_NAME, "failed.json" )
+    RELATED_NAME = pjoin( STATE_NAME, "related.json" )
+    HASHES_NAME = pjoin( STATE_NAME, "hashes.json" )
+    DEPLOY_NAME = pjoin( STATE_NAME, "deploy.json" )
+    PUBLISHED_NAME = ".sitegen-published.json"
+    USAGE_NAME = pjoin( STATE_NAME, "usage.json" )
+    HISTORY_NAME = pjoin( STATE_NAME, "history.sqlite" )
+    LOCK_NAME = pjoin( STATE_NAME, "lock" )
+    # Held shared by previews while they use the shared files, and
+    # exclusively by gc
+    SHARED_LOCK_NAME = pjoin( STATE_NAME, "shared.lock" )
+    # Index state of each directory, as <dir>/index.json below it
+    INDEXES_NAME = pjoin( STATE_NAME, "indexes" )
+    PREVIEWS_NAME = "previews"
+    SERVE_NAME = "serve"
+    WORKTREE_NAME = "worktree"
+    # State a preview starts from, with the index state
+    SEED_NAMES = ( REV_NAME, VARIABLES_NAME, MANIFEST_NAME, LINKS_NAME,
+            FAILED_NAME, RELATED_NAME, HASHES_NAME )
+
+    def __init__(self, conf_path, outgoing_path = None, meta_path = None,
+            verbose = False, shared_path = None, workers = None):
+        """Create a site generator with settings in the conf file; the
+        outgoing and meta paths can be overridden. Content-addressed files
+        (ASTs, plugin outputs) are kept in shared_path, by default the meta
+        path. Sites built together share their workers."""
         self.conf = CP.ConfigParser()
         self.conf.read( conf_path )
 
@@ -119,26 +883,86 @@ class SiteGenerator:
         incoming_path = self.conf.get( "paths", "incoming" )
         if not pexists( incoming_path ):
             raise ValueError( "%s does not exist"% incoming_path )
-        self.repo = git.Repo( incoming_path )
+        self.repo = open_repo( incoming_path )
 
-        self.meta_path = self.conf.get( "paths", "meta" )
-        if not pexists( self.meta_path ):
-            os.makedirs( self.meta_path )
-        self.outgoing_path = self.conf.get( "paths", "outgoing" )
+        self.meta_path = meta_path or self.conf.get( "paths", "meta" )
+        if not pexists( pjoin( self.meta_path, self.STATE_NAME ) ):
+            os.makedirs( pjoin( self.meta_path, self.STATE_NAME ) )
+        self.shared_path = shared_path or self.meta_path
+        # Paths in the meta store used by this process
+        self.used = set()
+        self.outgoing_path = outgoing_path or self.conf.get( "paths",
+                "outgoing" )
 
         # Construct template dict
         self.variables = dict( self.conf.items( "variables" ) )
-
-        # Configure the logger 
-        FORMAT = '%(asctime)-15s %(message)s'
-        logging.basicConfig( filename=pjoin( self.meta_path, "all.log" ),
-                level=logging.DEBUG, format=FORMAT )
+        self.substituter = Substituter( self.variables )
+        # Sections are named by the directory the rules apply to, e.g. [/]
+        self.ignore = self.rules( "ignore", "ignores" )
+        self.ignore_index = self.rules( "ignore-index" )
+        self.workers = workers or Workers( mp.cpu_count() )
+        self.jobs = self.workers.jobs
+
+        # Configure the logger; per-file messages are only logged when
+        # verbose
+        level = self.option( "log", "level", "info" ).upper()
+        self.log = logging.getLogger( "sitegen:%s" %
+                os.path.abspath( self.meta_path ) )
+        setup_logging( self.log, pjoin( self.meta_path, "all.log" ),
+                logging.DEBUG if verbose else getattr( logging, level ),
+                int( self.option( "log", "max-size", 1024 * 1024 ) ),
+                int( self.option( "log", "backups", 5 ) ) )
+        self.report = BuildReport()
+
+        self.manifest = Manifest( self.load( self.MANIFEST_NAME, {} ),
+                self.load( self.HASHES_NAME, {} ) )
+        self.links = LinkIndex( self.load( self.LINKS_NAME, {} ) )
+        # Variables used by each cached file, as of the last build
+        self.uses = self.load( self.VARIABLES_NAME, {} ).get( "uses", {} )
+        # Revision being built, for the history of its files
+        self.rev = "HEAD"
+        # Hash of the theme used by this build, if it cached one
+        self.theme_sha = None
+        # Precomputed index metadata, e.g. merged from shards
+        self.pages = {}
+        # (name, binsha) of blobs already cached by this process
+        self.cached = set()
+        self._reader = None
+        self.journal = Journal()
+        # Files that failed to compile, retried by the next build
+        self.failed = set( self.load( self.FAILED_NAME, [] ) )
+        # Related pages, if enabled
+        k = int( self.option( "/", "related", 0 ) )
+        self.related = Related( k, self.load( self.RELATED_NAME ) ) \
+                if k else None
+        # Plugins, in the order they run
+        self.plugins = [ load_plugin( spec )( self ) for spec in
+                self.option( "/", "plugins", "" ).split( "," ) if spec.strip() ]
+        self.plugins_key = hashlib.sha1( "\0".join( "%s:%s" % (
+            self.plugin_name( plugin ), plugin.cache_key() )
+            for plugin in self.plugins ) ).hexdigest() if self.plugins else ""
+
+    def option( self, section, option, default = None ):
+        """Get an option from the conf, or default if it is not set"""
+        if self.conf.has_option( section, option ):
+            return self.conf.get( section, option )
+        return default
 
         # Path accessors
     def metap( self, path ):
         """Retrieve path from the meta-store"""
+        self.used.add( path )
         return pjoin( self.meta_path, path )
 
+    def sharedp( self, path ):
+        """Retrieve path from the store of content-addressed files, which
+        previews share"""
+        self.used.add( path )
+        path = pjoin( self.shared_path, path )
+        if not pexists( dirname( path ) ):
+            os.makedirs( dirname( path ) )
+        return path
+
     def meta( self, path, mode = 'r' ):
         """Retrieve a file from the meta-store"""
         path = self.metap(path)
@@ -146,6 +970,20 @@ class SiteGenerator:
             os.makedirs( dirname( path ) )
         return open( path, mode )
 
+    def load( self, path, default = None ):
+        """Load a json file from the meta-store"""
+        if not pexists( self.metap( path ) ):
+            return default
+        return json.load( self.meta( path ) )
+
+    def save( self, path, obj ):
+        """Atomically save obj as a json file in the meta-store"""
+        tmp = path + ".tmp"
+        fd = self.meta( tmp, "w" )
+        json.dump( obj, fd )
+        fd.close()
+        os.rename( self.metap( tmp ), self.metap( path ) )
+
     def outgoingp( self, path ):
         """Retrieve path from the meta-store"""
         return pjoin( self.outgoing_path, path )
@@ -158,14 +996,12 @@ class SiteGenerator:
         return open( path, mode )
 
     # Convenience functions
-    def template( self, in_path, out_path = None ): 
-        """Template in_path using the variables section"""
-        if out_path is None:
-            out_path = in_path
-        # Replace the template variables
-        buf = string.Template( open( in_path, "r").read()
-                ).safe_substitute( self.variables )
-        open( out_path, "w" ).write( buf )
+    @property
+    def reader( self ):
+        """Shared cat-file channel, started on first use"""
+        if self._reader is None:
+            self._reader = BlobReader( self.repo.git_dir )
+        return self._reader
 
     def cache( self, name, blob_or_path): 
         """Cache a file at path in the meta directory"""
@@ -173,25 +1009,90 @@ class SiteGenerator:
             blob = blob_or_path
         else:
             blob = self.repo.tree()[ blob_or_path ]
+        if ( name, blob.binsha ) in self.cached:
+            return
         # For working tree files
         if blob.binsha == blob.NULL_BIN_SHA:
-            self.copy( blob.abspath, self.metap( name ) )
-        else:
-            blob.stream_data( self.meta( name, "w" ) )
+            src = open( blob.abspath, "r" )
+            self.store( name, blob.path, src )
+            src.close()
+            return
+        for hexsha, src in self.reader.stream( [ blob.hexsha ] ):
+            if src is None:
+                raise KeyError( hexsha )
+            self.store( name, blob.path, src )
+        self.cached.add( ( name, blob.binsha ) )
+
+    def prefetch( self, entries ):
+        """Cache the blobs of many entries with a single batch of cat-file
+        requests"""
+        with self.report.stage( "prefetch" ):
+            by_sha = {}
+            for entry in entries:
+                if ( entry.path, entry.binsha ) not in self.cached and \
+                        entry.binsha != git.Blob.NULL_BIN_SHA:
+                    by_sha.setdefault( entry.hexsha, [] ).append( entry )
+            for hexsha, src in self.reader.stream( by_sha ):
+                if src is None:
+                    self.log.warning( "Missing object %s", hexsha )
+                    continue
+                first = by_sha[ hexsha ][0]
+                self.store( first.path, first.path, src )
+                for entry in by_sha[ hexsha ]:
+                    if entry is not first:
+                        self.copy( self.metap( first.path ),
+                                self.metap( entry.path ) )
+                        if first.path in self.uses:
+                            self.uses[ entry.path ] = self.uses[ first.path ]
+                    self.cached.add( ( entry.path, entry.binsha ) )
+
+    def store( self, name, path, src ):
+        """Write the file path read from src to name in the meta directory"""
+        dst = self.meta( name + ".tmp", "w" )
         # If this is a text file, replace the template variables
-        ty = mimetypes.guess_type( blob.path )[0]
+        ty = mimetypes.guess_type( path )[0]
         if ty is not None and ty.split("/")[0] == "text":
-            self.template( self.metap(name) )
-
-    def ignores( self, base ):
-        """Extract set of ignored files"""
-        if self.conf.has_section( base ) and self.conf.has_option( base,
-                "ignores" ):
-            ignores = self.conf.get( base, "ignores" ).split(',')
-            ignores = map( lambda fn: pjoin( base, fn.strip() ), ignores )
+            used = self.substituter.stream( src, dst )
+        else:
+            used = None
+            shutil.copyfileobj( src, dst )
+        dst.close()
+        os.rename( self.metap( name + ".tmp" ), self.metap( name ) )
+
+        # Remember which variables the file depends on
+        if used:
+            self.uses[ path ] = sorted( used )
         else:
-            ignores = []
-        return set( ignores )
+            self.uses.pop( path, None )
+
+    def variables_key( self, path ):
+        """Digest of the values of the variables used by path"""
+        used = self.uses.get( path )
+        if not used:
+            return ""
+        values = json.dumps( [ self.variables.get( name ) for name in used ] )
+        return hashlib.sha1( values ).hexdigest()[:8]
+
+    def affected( self ):
+        """Paths using a variable whose value changed since the last build"""
+        old = self.load( self.VARIABLES_NAME, {} ).get( "values", {} )
+        changed = set( name for name in set( old ) | set( self.variables )
+                if old.get( name ) != self.variables.get( name ) )
+        return set( path for path, used in self.uses.items()
+                if changed.intersection( used ) )
+
+    def rules( self, *options ):
+        """Compile the comma separated patterns in options of every
+        section into a PathMatcher"""
+        rules = []
+        for section in self.conf.sections():
+            if section in ( "paths", "variables", "log", "meta" ):
+                continue
+            for option in options:
+                if self.conf.has_option( section, option ):
+                    rules += [ ( section, pattern ) for pattern in
+                            self.conf.get( section, option ).split(',') ]
+        return PathMatcher( rules )
 
     def current_rev( self ):
         """Get the current revision from meta folder"""
@@ -200,62 +1101,361 @@ class SiteGenerator:
         else:
             return None
 
+    # Plugins
+    def plugin_name( self, plugin ):
+        return plugin.name or plugin.__class__.__name__
+
+    def run_hook( self, hook, path, text ):
+        """Pass text through hook of every plugin that defines it. Outputs
+        are memoized by plugin, cache key, path and input, and each plugin
+        is timed as its own stage."""
+        for plugin in self.plugins:
+            if not defines_hook( plugin.__class__, hook ):
+                continue
+            name = self.plugin_name( plugin )
+            with self.report.stage( "plugin " + name ):
+                key = hashlib.sha1( "\0".join( [ hook, name,
+                    plugin.cache_key(), path, text ] ) ).hexdigest()
+                memo = self.sharedp( pjoin( "plugins", key[:2], key ) )
+                if pexists( memo ):
+                    text = open( memo ).read()
+                    self.report.count( name + " cached" )
+                    continue
+                text = getattr( plugin, hook )( path, text )
+                fd = open( tmpname( memo ), "w" )
+                fd.write( text )
+                fd.close()
+                os.rename( tmpname( memo ), memo )
+        return text
+
+    def pre_render( self, path ):
+        """Path of the source of the page at path, after the pre-render
+        hooks"""
+        text = self.meta( path ).read()
+        out = self.run_hook( "pre_render", path, text )
+        if out == text:
+            return self.metap( path )
+        name = pjoin( "plugins", "src", path )
+        fd = self.meta( name, "w" )
+        fd.write( out )
+        fd.close()
+        return self.metap( name )
+
+    def post_render( self, target ):
+        """Run the post-render hooks over the html written to target"""
+        if not self.plugins:
+            return
+        name = os.path.relpath( target, self.outgoing_path )
+        html = open( target ).read()
+        out = self.run_hook( "post_render", name, html )
+        if out != html:
+            fd = open( target + ".tmp", "w" )
+            fd.write( out )
+            fd.close()
+            os.rename( target + ".tmp", target )
+
     # Compilation
-    def pandoc( self, src, target ):
+    def pandoc( self, src, target, variables = None ):
         """Run pandoc on src to target. Uses conf to get theme"""
 
         if not pexists( dirname( target ) ): 
             os.makedirs( dirname( target ) )
 
-        cmd = "pandoc --mathjax -s --template %s -o %s %s" % (
-                self.metap("theme.html"), target, src )
+        cmd = "pandoc --mathjax -s --template %s -o %s" % (
+                self.metap("theme.html"), target )
+        cmd = cmd.split() + self.pandoc_variables( variables ) + [ src ]
+
+        if self.workers.call( cmd ) == 0:
+            self.post_render( target )
+            self.log.debug( "Compiled file %s", target)
+            self.report.count( "compiled" )
+            return True
+        else:
+            self.log.warning( "Error compiling file %s", target )
+            self.report.count( "failed" )
+            return False
+
+    def read( self, src, ast ):
+        """Parse src into a pandoc json AST"""
+        if not pexists( dirname( ast ) ): 
+            os.makedirs( dirname( ast ) )
+
+        cmd = "pandoc -f markdown -t json -o %s %s" % ( tmpname( ast ), src )
+
+        if self.workers.call( cmd.split() ) == 0:
+            os.rename( tmpname( ast ), ast )
+            self.report.count( "parsed" )
+            return True
+        else:
+            self.log.warning( "Error reading file %s", src )
+            self.report.count( "failed" )
+            return False
+
+    def write( self, ast, target, variables = None ):
+        """Render a pandoc json AST to target. Uses conf to get theme"""
+
+        if not pexists( dirname( target ) ): 
+            os.makedirs( dirname( target ) )
+
+        cmd = "pandoc -f json --mathjax -s --template %s -o %s" % (
+                self.metap("theme.html"), target )
+        cmd = cmd.split() + self.pandoc_variables( variables ) + [ ast ]
 
-        proc = sp.Popen( cmd.split() )
-        if proc.wait() == 0:
-            logging.info( "Compiled file %s", target)
+        if self.workers.call( cmd ) == 0:
+            self.post_render( target )
+            self.log.debug( "Compiled file %s", target)
+            self.report.count( "compiled" )
+            return True
         else:
-            logging.info( "Error compiling file %s", target )
+            self.log.warning( "Error compiling file %s", target )
+            self.report.count( "failed" )
+            return False
+
+    def pandoc_variables( self, variables ):
+        """Arguments setting template variables for pandoc"""
+        args = []
+        for key, value in sorted( ( variables or {} ).items() ):
+            args += [ "-V", "%s=%s" % ( key, value ) ]
+        return args
+
+    def page_variables( self, path ):
+        """Template variables for the page at path"""
+        if self.related is None or not self.related.related.get( path ):
+            return {}
+        root = self.variables.get( "urlroot", "" ).rstrip( "/" )
+        return { "related": "<ul>%s</ul>" % "".join(
+            '<li><a href="%s/%s">%s</a></li>' % ( root, target_name( p ),
+                cgi.escape( self.related.titles.get( p, p ) ) )
+            for p in self.related.related[ path ] ) }
+
+    def astp( self, blob ):
+        """Path of the cached AST of blob"""
+        key = blob.hexsha
+        if self.variables_key( blob.path ):
+            key += "-" + self.variables_key( blob.path )
+        if self.plugins_key:
+            key += "-" + self.plugins_key[:8]
+        return self.sharedp( pjoin( "ast", key + ".json" ) )
 
     def copy( self, infile, outfile ):
         """Copy file from A to B"""
         if not pexists( dirname( outfile ) ):
             os.makedirs( dirname( outfile ) )
-        open( outfile, "w" ).write( open( infile, "r" ).read() )
+        shutil.copyfile( infile, outfile )
 
 
     def compile( self, blob ):
-        """Compile blob to outgoing"""
-        self.cache( blob.path, blob )
-
-        # Compile pandoc files
-        if blob.path.endswith( PANDOC_EXTN ):
-            path = self.outgoingp( blob.path[:-len(PANDOC_EXTN)] + ".html" )
-            self.pandoc( self.metap(blob.path), path )
+        """Compile blob to outgoing; returns False if it failed"""
+        with self.report.stage( "compile" ):
+            self.cache( blob.path, blob )
+
+            # Compile pandoc files
+            name = target_name( blob.path )
+            if blob.path.endswith( PANDOC_EXTN ):
+                if self.related is not None:
+                    self.related.update( blob.path, blob.hexsha,
+                            self.meta( blob.path ).read() )
+                variables = self.page_variables( blob.path )
+                if blob.binsha == blob.NULL_BIN_SHA:
+                    ok = self.pandoc( self.pre_render( blob.path ),
+                            self.outgoingp( name ), variables )
+                else:
+                    ast = self.astp( blob )
+                    if pexists( ast ):
+                        self.report.count( "ast hits" )
+                    ok = ( pexists( ast ) or self.read(
+                        self.pre_render( blob.path ), ast ) ) and \
+                                self.write( ast, self.outgoingp( name ),
+                                        variables )
+                if ok:
+                    self.manifest.add( name, blob.path )
+            else:
+                # Copy the rest
+                self.copy( self.metap(blob.path), self.outgoingp( name ) )
+                self.manifest.add( name, blob.path )
+                self.report.count( "copied" )
+                ok = True
+
+            if ok:
+                self.failed.discard( blob.path )
+            else:
+                self.failed.add( blob.path )
+            return ok
+
+    def worktree_blob( self, path ):
+        """Blob for the working tree file at path"""
+        return git.Blob( self.repo, git.Blob.NULL_BIN_SHA, path = path )
+
+    def worktree_paths( self ):
+        """Yield the paths of files in the working tree, pruning ignored
+        directories"""
+        root = self.repo.working_tree_dir
+        for dirpath, dirnames, filenames in os.walk( root ):
+            base = os.path.relpath( dirpath, root )
+            base = "" if base == "." else base
+            dirnames[:] = [ d for d in dirnames if d != ".git" and
+                    not self.ignore.match( pjoin( base, d ), True ) ]
+            for fn in filenames:
+                if not self.ignore.match( pjoin( base, fn ) ):
+                    yield pjoin( base, fn )
+
+    def worktree_changes( self ):
+        """Find working tree files modified or deleted since the last working
+        tree build. Like git's index, a file is only hashed if its mtime,
+        size or inode changed. Returns the paths modified and deleted, and
+        the new stat cache."""
+        root = self.repo.working_tree_dir
+        old = self.load( self.STAT_NAME, {} )
+        new = {}
+        modifys = []
+        for path in self.worktree_paths():
+            st = os.stat( pjoin( root, path ) )
+            stat = [ st.st_mtime, st.st_size, st.st_ino ]
+            entry = old.get( path )
+            if entry is not None and entry[:3] == stat:
+                new[ path ] = entry
+                continue
+            sha = git_hash( pjoin( root, path ) )
+            if entry is None or entry[3] != sha:
+                modifys.append( path )
+            new[ path ] = stat + [ sha ]
+        deletes = [ path for path in old if path not in new ]
+
+        # Files modified within the granularity of mtime could change again
+        # unnoticed; force them to be hashed next time
+        now = time.time()
+        for entry in new.values():
+            if entry[0] >= now - 1:
+                entry[0] = 0
+        return modifys, deletes, new
+
+    def blob( self, path, binsha ):
+        """Load the blob for a (path, binsha) work item"""
+        return git.Blob( self.repo, binsha, path = path )
+
+    def resume( self, item, name = None, src = None ):
+        """Check if an interrupted build already finished item; if so, put
+        its output name back in the manifest"""
+        if item not in self.journal:
+            return False
+        if name is not None:
+            self.manifest.add( name, src )
+        return True
+
+    def rewrite( self, item ):
+        """Render a (path, binsha) work item again from its cached AST"""
+        if self.resume( "W " + item[0] ):
+            return
+        if self.render( item ):
+            self.journal.record( "W " + item[0] )
+
+    def render( self, item ):
+        """Render a (path, binsha) work item, from its cached AST if there is
+        one; returns False if it failed"""
+        blob = self.blob( *item )
+        ast = self.astp( blob )
+        if pexists( ast ):
+            self.report.count( "ast hits" )
+            name = target_name( blob.path )
+            ok = self.write( ast, self.outgoingp( name ),
+                    self.page_variables( blob.path ) )
+            if ok:
+                self.manifest.add( name, blob.path )
+            else:
+                self.failed.add( blob.path )
         else:
-            # Copy the rest
-            path = self.outgoingp( blob.path )
-            self.copy( self.metap(blob.path), path )
+            ok = self.compile( blob )
+        return ok
+
+    def theme_changed( self ):
+        """Record the hash of the cached theme of this build, with its
+        variables substituted; returns True if it differs from the theme of
+        the last build. The theme is usually ignored, so neither its changes
+        nor those of the variables it uses show up in changesets."""
+        self.theme_sha = git_hash( self.metap( "theme.html" ) )
+        return self.load( self.VARIABLES_NAME, {} ).get( "theme" ) != \
+                self.theme_sha
+
+    def retheme( self, tree, cs ):
+        """Run the writer over all pages not in cs, e.g. on a new theme, and
+        render the indexes again"""
+        changed = set( b.path for b in cs.modifys )
+        pages = ( item for item in ChangeSet.walk( tree, self.ignore )
+                if item[0].endswith( PANDOC_EXTN ) and item[0] not in changed )
+        count = sum( 1 for _ in
+                self.workers.pool.imap_unordered( self.rewrite, pages ) )
+        self.log.info( "Rewrote %d pages", count )
+        self.build_indexes( tree )
+
+    def relate( self ):
+        """Update related pages, and render again the pages whose related
+        pages changed"""
+        try:
+            changed = self.related.compute()
+        except ImportError:
+            self.log.warning( "Related pages need numpy and scipy" )
+            return
+        pages = [ ( path, self.related.shas[ path ].decode( "hex" ) )
+                for path in changed ]
+        self.workers.pool.map( self.render, pages )
+        self.report.count( "related", len( pages ) )
+        self.save( self.RELATED_NAME, self.related.to_dict() )
+
+    def compile_all( self, tree ):
+        """Compile every blob under tree as the walk reaches it, then build
+        the indexes and remove what is no longer in tree"""
+        sources = set()
+        def walk():
+            for path, binsha in ChangeSet.walk( tree, self.ignore ):
+                sources.add( path )
+                if not self.resume( "C " + path, target_name( path ), path ):
+                    yield path, binsha
+        for batch in batches( walk(), self.BATCH_SIZE ):
+            self.prefetch( Entry( path, binsha ) for path, binsha in batch )
+            for path, binsha in batch:
+                if self.compile( self.blob( path, binsha ) ):
+                    self.journal.record( "C " + path )
+        sources.update( self.build_indexes( tree ) )
+        self.prune( sources )
+
+    def prune( self, sources ):
+        """Remove the published files whose source, a file or a directory
+        for indexes, is not in sources; full builds start from the old
+        manifest, so this is how they notice deletions"""
+        for name, src in sorted( self.manifest.entries.items() ):
+            if src in sources:
+                continue
+            if name == target_name( src ):
+                self.delete( self.blob( src, git.Blob.NULL_BIN_SHA ) )
+            else:
+                self.manifest.remove( name )
+                if pexists( self.outgoingp( name ) ):
+                    os.unlink( self.outgoingp( name ) )
 
     def delete( self, blob ):
         """Delete blob from outgoing"""
-
-        # Handle extension changes
-        if blob.path.endswith( PANDOC_EXTN ):
-            path = blob.path[:-len(PANDOC_EXTN)] + ".html"
-        else:
-            path = blob.path
-        path = self.outgoingp( path )
-        if os.path.exists( path ):
-            os.unlink( path )
-            logging.info( "Deleted %s", path)
-        else:
-            logging.info( "Not found: %s", path)
+        with self.report.stage( "delete" ):
+
+            # Handle extension changes
+            name = target_name( blob.path )
+            self.manifest.remove( name )
+            self.uses.pop( blob.path, None )
+            self.failed.discard( blob.path )
+            if self.related is not None:
+                self.related.remove( blob.path )
+            path = self.outgoingp( name )
+            if os.path.exists( path ):
+                os.unlink( path )
+                self.log.debug( "Deleted %s", path)
+                self.report.count( "deleted" )
+            else:
+                self.log.debug( "Not found: %s", path)
 
     # Update handlers
     def changes( self, from_rev, to_rev = None ):
         """Get list of all files that need to be compiled at this level"""
         diffs = self.repo.commit( from_rev ).diff( to_rev )
-        return ChangeSet.from_diffiter( from_rev, diffs )
+        return ChangeSet.from_diffiter( from_rev, diffs, self.ignore )
 
     def apply( self, tree, cs ):
         """Recursively apply the changeset in this directory base"""
@@ -263,47 +1463,74 @@ class SiteGenerator:
 
         if len(cs) == 0: 
             return
-        ignores = self.ignores( base )
 
         # Apply updates to all files
         cs_ = cs.pop( base )
-        logging.info( "Applying %d changes in %s", len(cs_), base )
-        for blob in cs_.modifys.difference( ignores ):
-            self.compile( blob )
-        for blob in cs_.deletes.difference( ignores ):
-            self.delete( blob )
-
-        # Recurse
+        self.log.debug( "Applying %d changes in %s", len(cs_), base )
+        for entry in cs_.modifys:
+            if not self.ignore.match( entry.path ) and not self.resume(
+                    "C " + entry.path, target_name( entry.path ), entry.path ):
+                if self.compile( entry.blob( self.repo ) ):
+                    self.journal.record( "C " + entry.path )
+        for entry in cs_.deletes:
+            if not self.ignore.match( entry.path ):
+                self.delete( entry )
+
+        # Recurse, skipping ignored subtrees
         for t in tree.trees:
-            cs = self.apply( t, cs )
+            if not self.ignore.match( t.path, True ):
+                cs = self.apply( t, cs )
 
         # Update index
         self.build_index( tree )
 
         return cs
 
-    def extract_meta( self, blob ):
-        """Extract a timestamp from a post file"""
-        self.cache( blob.path, blob )
-        lines = self.meta( blob.path ).readlines()
+    def header( self, blob ):
+        """Parse the % block of blob, reading only as far as its end: from
+        the cached copy if this build has one, else from the working tree
+        or the object store"""
+        if ( blob.path, blob.binsha ) in self.cached:
+            fd = self.meta( blob.path )
+            header = parse_header( fd )
+            fd.close()
+            return header
 
-        commits = self.repo.blame( "HEAD", blob.path )
+        if blob.binsha == blob.NULL_BIN_SHA:
+            fd = open( blob.abspath, "r" )
+            title, authors, date, headers = parse_header( fd )
+            fd.close()
+        else:
+            for hexsha, src in self.reader.stream( [ blob.hexsha ] ):
+                if src is None:
+                    raise KeyError( hexsha )
+                title, authors, date, headers = parse_header(
+                        iter( src.readline, "" ) )
+        # Like the cached copy, replace the template variables
+        sub = lambda text: self.substituter.sub( text, set() )
+        return sub( title ), map( sub, authors ), sub( date ), dict(
+                (key, sub( value )) for key, value in headers.items() )
 
-        # First line is reserved for title
-        # If title starts with a %, delete
+    def extract_meta( self, blob ):
+        """Extract the title, timestamps, authors and headers of a post
+        file"""
+        # Commit times of the file, newest first; none if uncommitted
+        stamps = [ int( stamp ) for stamp in self.repo.git.log( self.rev,
+            "--format=%ct", "--", blob.path ).split() ] or [ time.time() ]
+
+        # Only pandoc files have a title block
+        date, authors, headers = "", [], {}
         if blob.path.endswith( PANDOC_EXTN ):
-            title = lines[0].strip()
-            if title.startswith("%"):
-                title = title[1:].strip()
+            title, authors, date, headers = self.header( blob )
         else:
             title = "`%s`" % blob.path
 
         # Get the date
         created = None
         fmts = ["%b %d %Y", "%B %d %Y", "%d %b %Y"]
-        if len( lines ) >= 3 and lines[2].startswith("%"):
+        if date:
             try:
-                created = get_date( fmts, lines[2][1:].strip() )
+                created = get_date( fmts, date )
             except ValueError:
                 created = None
 
@@ -316,12 +1543,10 @@ class SiteGenerator:
 
         # Give up and use the commit time
         if created is None:
-            created = time.strptime( time.ctime(
-                commits[0][0].committed_date ) )
+            created = time.localtime( stamps[-1] )
 
-        updated = time.strptime( time.ctime(
-            commits[-1][0].committed_date ) )
-        return title, created, updated
+        updated = time.localtime( stamps[0] )
+        return title, created, updated, authors, headers
 
     def find(self, tree, x):
         """Workaround because x in tree doesn't work"""
@@ -331,91 +1556,1135 @@ class SiteGenerator:
             return None
 
     # Index generation
-    def build_index(self, tree):
-        """Build index for tree"""
+    def section_option( self, base, option, default = None ):
+        """Get an option for the directory base from its section, e.g.
+        [/blog], falling back to the [/] section"""
+        for section in ( "/" + base, base ):
+            if self.conf.has_option( section, option ):
+                return self.conf.get( section, option )
+        return self.option( "/", option, default )
+
+    def index_entries( self, tree, cached ):
+        """Map the path of each file listed in the index of tree to its
+        [sha, title, created, updated, description]; metadata is only
+        extracted again for blobs that changed since it was cached"""
+        entries = {}
+        for blob in tree.blobs:
+            if self.ignore.match( blob.path ):
+                continue
+            if blob.path in self.pages:
+                meta = self.pages[ blob.path ]
+            elif cached.get( blob.path, [None] )[0] == blob.hexsha and \
+                    len( cached[ blob.path ] ) == 5:
+                meta = cached[ blob.path ][1:]
+            else:
+                title, created, updated, authors, headers = \
+                        self.extract_meta( blob )
+                meta = ( title, created, updated,
+                        headers.get( "description", "" ) )
+            title, created, updated, description = meta
+            # Times are kept as lists, which json can store
+            entries[ blob.path ] = [ blob.hexsha, title, list( created ),
+                    list( updated ), description ]
+        return entries
+
+    def index_name( self, base, number ):
+        """Name of page number of the index of base, without extension"""
+        if number == 1:
+            return pjoin( base, "index" )
+        return pjoin( base, "page", str( number ) )
+
+    def index_page( self, tree, slices, number, size ):
+        """Markdown for page number of an index split into slices"""
+        title = tree.name.capitalize()
+        if len( slices ) > 1:
+            title += " (page %d of %d)" % ( number, len( slices ) )
+        lines = [ "%% %s" % title, "" ]
+        for i, (title, created, path, description) in enumerate(
+                slices[number-1], (number - 1) * size + 1 ):
+            lines.append( " %d. [%s]($urlroot/%s) _(%s)_" % ( i,
+                title, target_name( path ),
+                time.strftime( "%d %b %Y", created ) ) )
+            if description:
+                lines[-1] += ": " + description
+
+        # Navigation between pages
+        nav = []
+        if number > 1:
+            nav.append( "[Newer]($urlroot/%s.html)" %
+                    self.index_name( tree.path, number - 1 ) )
+        if number < len( slices ):
+            nav.append( "[Older]($urlroot/%s.html)" %
+                    self.index_name( tree.path, number + 1 ) )
+        if nav:
+            lines += [ "", " | ".join( nav ) ]
+        return self.substituter.sub( "\n".join( lines ) + "\n", set() )
+
+    def archive_page( self, tree, key, groups ):
+        """Markdown for the archive page of key, a year or year/month"""
+        siblings = sorted( k for k in groups if len( k ) == len( key ) )
+        at = siblings.index( key )
+        if len( key ) == 4:
+            label = lambda k: k
+        else:
+            label = lambda k: time.strftime( "%B %Y",
+                    time.strptime( k, "%Y/%m" ) )
+
+        lines = [ "%% %s: %s" % ( tree.name.capitalize(), label( key ) ) ]
+        if len( key ) > 4:
+            lines.append( "" )
+        entries = sorted( groups[ key ], key=lambda i: i[1], reverse=True )
+        month = None
+        for i, (title, created, path) in enumerate( entries, 1 ):
+            # Year pages are split by month
+            if len( key ) == 4 and time.strftime( "%m", created ) != month:
+                month = time.strftime( "%m", created )
+                lines += [ "", "## [%s]($urlroot/%s)" % (
+                    time.strftime( "%B", created ),
+                    pjoin( tree.path, key, month, "index.html" ) ), "" ]
+            lines.append( " %d. [%s]($urlroot/%s) _(%s)_" % ( i,
+                title, target_name( path ),
+                time.strftime( "%d %b %Y", created ) ) )
+
+        # Navigation to the adjacent archives, and up to the year
+        nav = []
+        if at > 0:
+            nav.append( "[%s]($urlroot/%s)" % ( label( siblings[at-1] ),
+                pjoin( tree.path, siblings[at-1], "index.html" ) ) )
+        if len( key ) > 4:
+            nav.append( "[%s]($urlroot/%s)" % ( key[:4],
+                pjoin( tree.path, key[:4], "index.html" ) ) )
+        if at < len( siblings ) - 1:
+            nav.append( "[%s]($urlroot/%s)" % ( label( siblings[at+1] ),
+                pjoin( tree.path, siblings[at+1], "index.html" ) ) )
+        lines += [ "", " | ".join( nav ) ]
+        return self.substituter.sub( "\n".join( lines ) + "\n", set() )
+
+    def build_archive( self, tree, entries, state, theme ):
+        """Render the year and month archive pages of tree that a change in
+        entries touches. Returns the digests of all archive pages."""
         base = tree.path
+        keys = lambda created: [ time.strftime( "%Y", created ),
+                time.strftime( "%Y/%m", created ) ]
+
+        groups = {}
+        for path, (sha, title, created, updated, description) in \
+                entries.items():
+            created = time.struct_time( created )
+            for key in keys( created ):
+                groups.setdefault( key, [] ).append( (title, created, path) )
+
+        old = state.get( "archive", {} )
+        if state.get( "theme" ) != theme:
+            touched = set( groups ) | set( old )
+        else:
+            # Pages of the entries that changed, before and after
+            cached = state.get( "entries", {} )
+            touched = set()
+            for path in set( entries ) | set( cached ):
+                if entries.get( path ) != cached.get( path ):
+                    for entry in ( entries.get( path ), cached.get( path ) ):
+                        if entry is not None:
+                            touched.update( keys( time.struct_time( entry[2] ) ) )
+            # A page added or removed changes the navigation of its
+            # neighbours
+            every = sorted( set( groups ) | set( old ) )
+            for key in set( groups ) ^ set( old ):
+                siblings = [ k for k in every if len( k ) == len( key ) ]
+                at = siblings.index( key )
+                touched.update( siblings[ max( at - 1, 0 ) : at + 2 ] )
+
+        digests = dict( (key, old[ key ]) for key in groups if key in old )
+        for key in touched:
+            name = pjoin( base, key, "index" )
+            if key not in groups:
+                self.manifest.remove( name + ".html" )
+                if pexists( self.outgoingp( name + ".html" ) ):
+                    os.unlink( self.outgoingp( name + ".html" ) )
+                continue
+            text = self.run_hook( "index", base,
+                    self.archive_page( tree, key, groups ) )
+            digest = hashlib.sha1( theme + text ).hexdigest()
+            if old.get( key ) == digest and \
+                    pexists( self.outgoingp( name + ".html" ) ):
+                continue
+            fd = self.meta( name + ".md", "w" )
+            fd.write( text )
+            fd.close()
+            if self.pandoc( self.metap( name + ".md" ),
+                    self.outgoingp( name + ".html" ) ):
+                self.manifest.add( name + ".html", base )
+                digests[ key ] = digest
+            else:
+                digests.pop( key, None )
+        return digests
 
-        # TODO: Replace template variables
-        if self.find( tree, "index.md" ) is not None or self.find( tree,
-                "index.html" ) is not None:
-            logging.info( "Keeping existing index for %s", base )
-            return
-        logging.info( "Building index for %s", base )
-
-        # Create index of all files
-        idx = []
-        for blob in tree.blobs:
-            title, created, updated = self.extract_meta( blob )
+    def build_indexes( self, tree ):
+        """Build indexes for tree and every directory below it; returns the
+        directories visited"""
+        bases = [ tree.path ]
+        for t in tree.trees:
+            if not self.ignore.match( t.path, True ):
+                bases += self.build_indexes( t )
+        self.build_index( tree )
+        return bases
 
-            if blob.path.endswith(PANDOC_EXTN):
-                path = blob.path[:-len(PANDOC_EXTN)] + ".html"
+    def build_index(self, tree):
+        """Build index for tree"""
+        with self.report.stage( "index" ):
+            base = tree.path
+
+            if self.ignore_index.match( base, True ):
+                self.log.debug( "Ignoring index for %s", base )
+                return
+            if self.find( tree, "index.md" ) is not None or self.find( tree,
+                    "index.html" ) is not None:
+                self.log.debug( "Keeping existing index for %s", base )
+                return
+            if self.resume( "I " + base, pjoin(base, "index.html"), base ):
+                return
+            self.log.debug( "Building index for %s", base )
+
+            # Entries are sorted newest first, and split into pages; only
+            # the pages whose contents changed are rendered again
+            state_name = pjoin( self.INDEXES_NAME, base, "index.json" )
+            state = self.load( state_name, {} )
+            entries = self.index_entries( tree, state.get( "entries", {} ) )
+            idx = sorted( ( (title, time.struct_time( created ), path,
+                description) for path, (sha, title, created, updated,
+                    description) in entries.items() ),
+                key=lambda i: i[1], reverse=True )
+            size = int( self.section_option( base, "paginate", 0 ) ) or \
+                    max( len( idx ), 1 )
+            slices = [ idx[i:i+size] for i in
+                    range( 0, max( len( idx ), 1 ), size ) ]
+
+            old = state.get( "pages", [] )
+            digests = []
+            theme = git_hash( self.metap( "theme.html" ) ) + self.plugins_key
+            for number in range( 1, len( slices ) + 1 ):
+                name = self.index_name( base, number )
+                text = self.run_hook( "index", base,
+                        self.index_page( tree, slices, number, size ) )
+                digest = hashlib.sha1( theme + text ).hexdigest()
+                if number <= len( old ) and old[number-1] == digest and \
+                        pexists( self.outgoingp( name + ".html" ) ):
+                    digests.append( digest )
+                    continue
+                fd = self.meta( name + ".md", "w" )
+                fd.write( text )
+                fd.close()
+                if self.pandoc( self.metap( name + ".md" ),
+                        self.outgoingp( name + ".html" ) ):
+                    self.manifest.add( name + ".html", base )
+                    digests.append( digest )
+                else:
+                    digests.append( None )
+
+            # Remove pages past the end
+            for number in range( len( slices ) + 1, len( old ) + 1 ):
+                name = self.index_name( base, number ) + ".html"
+                self.manifest.remove( name )
+                if pexists( self.outgoingp( name ) ):
+                    os.unlink( self.outgoingp( name ) )
+
+            archive = {}
+            if self.section_option( base, "archive", "no" ).lower() in (
+                    "1", "yes", "true", "on" ):
+                archive = self.build_archive( tree, entries, state, theme )
+
+            self.save( state_name,
+                    { "entries": entries, "pages": digests,
+                        "archive": archive, "theme": theme } )
+
+            # If no existing index, build an index
+            self.log.debug( "Updating index for %s", base )
+            self.report.count( "indexes" )
+            self.journal.record( "I " + base )
+
+    # Link checking
+    def extract_links( self, name ):
+        """Extract the published paths that a rendered page links to"""
+        root = self.variables.get( "urlroot", "" ).rstrip( "/" ) + "/"
+        targets = set()
+        for link in LINK_RE.findall( open( self.outgoingp( name ) ).read() ):
+            if not link.startswith( root ):
+                continue
+            link = link[len(root):]
+            if link == "" or link.endswith( "/" ):
+                link += "index.html"
+            targets.add( link )
+        return targets
+
+    def update_links( self ):
+        """Rescan the pages published or removed in this build"""
+        for name in self.manifest.removed:
+            self.links.drop( name )
+        for name in self.manifest.updated:
+            if name.endswith( ".html" ) and pexists( self.outgoingp( name ) ):
+                self.links.update( name, self.extract_links( name ) )
+        self.save( self.LINKS_NAME, self.links.to_dict() )
+
+    def check_links( self ):
+        """Report links that do not resolve to a published path"""
+        broken = self.links.broken( self.manifest )
+        for page, target in broken:
+            if target in self.manifest.removed:
+                self.log.warning( "%s links to deleted %s", page, target )
+                print "%s: link to deleted %s" % (page, target)
             else:
-                path = blob.path
-            idx.append( (title, created, updated, path) )
-
-        fd = self.meta( pjoin(base, "index.md"), "w" )
-        fd.write( "%% %s\n\n"%(tree.name.capitalize()) )
-        idx.sort( key=lambda i: i[1], reverse=True )
-        for i in range(len(idx)):
-            title, created, updated, path = idx[i]
-            fd.write( " %d. [%s]($urlroot/%s) _(%s)_\n"%( i+1,
-                title, path, time.strftime( "%d %b %Y", created) ) )
+                self.log.warning( "%s links to missing %s", page, target )
+                print "%s: broken link to %s" % (page, target)
+        return broken
+
+    # Build bookkeeping
+    def begin( self, description ):
+        """Start the report for a build"""
+        print "%s..." % description
+        self.log.info( "%s initiated", description )
+        self.report = BuildReport( description )
+
+    def summarize( self ):
+        """Log a summary line for the build"""
+        summary = self.report.summary()
+        self.log.info( "Build finished in %s", summary )
+        print "Done in %s" % summary
+
+    def deploy_delta( self ):
+        """Hash the files written by this build, and save the paths
+        uploaded, deleted and unchanged since the last build"""
+        delta = { "uploaded": {}, "deleted": [], "unchanged": {} }
+        # Files published before hashes were kept are hashed once
+        names = self.manifest.updated | ( set( self.manifest.entries ) -
+                set( self.manifest.hashes ) )
+        for name in names:
+            if name not in self.manifest or \
+                    not pexists( self.outgoingp( name ) ):
+                continue
+            if name in self.manifest.updated:
+                self.report.count( "bytes written",
+                        os.path.getsize( self.outgoingp( name ) ) )
+            digest = git_hash( self.outgoingp( name ) )
+            if self.manifest.rehash( name, digest ):
+                delta[ "uploaded" ][ name ] = digest
+        for name, digest in self.manifest.hashes.items():
+            if name not in delta[ "uploaded" ]:
+                delta[ "unchanged" ][ name ] = digest
+        delta[ "deleted" ] = sorted( name for name in self.manifest.removed
+                if name not in self.manifest )
+        self.save( self.DEPLOY_NAME, delta )
+        self.report.count( "uploaded", len( delta[ "uploaded" ] ) )
+        return delta
+
+    # Meta store garbage collection
+    def record_usage( self ):
+        """Count this build, and mark the meta files it used"""
+        usage = self.load( self.USAGE_NAME, {} )
+        build = usage.get( "build", 0 ) + 1
+        used = usage.get( "used", {} )
+        for path in list( self.used ):
+            if not path.endswith( ".tmp" ):
+                used[ path ] = build
+        self.save( self.USAGE_NAME, { "build": build, "used": used } )
+
+    def reachable( self ):
+        """Meta files needed by the current tree: cached copies, ASTs and
+        index state"""
+        rev = self.current_rev()
+        tree = self.repo.commit( rev ).tree if rev else self.repo.tree()
+        index = lambda base: pjoin( self.INDEXES_NAME, base, "index.json" )
+        keep = set( [ "theme.html", index( "" ) ] )
+        for path, binsha in ChangeSet.walk( tree, self.ignore ):
+            keep.add( path )
+            if path.endswith( PANDOC_EXTN ):
+                keep.add( os.path.relpath( self.astp( Entry( path, binsha ) ),
+                    self.meta_path ) )
+            base = dirname( path )
+            while base and index( base ) not in keep:
+                keep.add( index( base ) )
+                base = dirname( base )
+        return keep
+
+    def gc( self, collect = True ):
+        """Evict files from the meta store. If collect, evict those not
+        reachable from the current tree or not used in the last keep-builds
+        builds; then evict the least recently used until the store fits in
+        max-size. Returns the paths evicted."""
+        if self.shared_path == self.meta_path:
+            with locked( self.metap( self.SHARED_LOCK_NAME ) ):
+                return self.evict( collect )
+        return self.evict( collect )
+
+    def evict( self, collect ):
+        """Evict files from the meta store, for gc"""
+        with self.report.stage( "gc" ):
+            usage = self.load( self.USAGE_NAME, {} )
+            build = usage.get( "build", 0 )
+            last = usage.get( "used", {} )
+            keep = int( self.option( "meta", "keep-builds", 10 ) )
+            cap = int( self.option( "meta", "max-size", 0 ) )
+
+            # Sizes of the evictable files; shard, preview and server stores
+            # are left alone, as is the build state
+            is_index = lambda path: path.startswith(
+                    self.INDEXES_NAME + os.sep )
+            files = {}
+            total = 0
+            for dirpath, dirnames, filenames in os.walk( self.meta_path ):
+                base = os.path.relpath( dirpath, self.meta_path )
+                base = "" if base == "." else base
+                if base == "":
+                    dirnames[:] = [ d for d in dirnames
+                            if not d.startswith( "shard-" ) and
+                            d not in ( self.PREVIEWS_NAME, self.SERVE_NAME,
+                                self.WORKTREE_NAME ) ]
+                for fn in filenames:
+                    path = pjoin( base, fn )
+                    size = os.path.getsize( pjoin( dirpath, fn ) )
+                    total += size
+                    if ( base == "" and fn.startswith( "all.log" ) ) or (
+                            path.startswith( self.STATE_NAME + os.sep ) and
+                            not is_index( path ) ):
+                        continue
+                    files[ path ] = size
+
+            # Index state is only dropped with its directory
+            stale = lambda path: last.get( path, 0 ) <= build - keep and \
+                    not is_index( path )
+            evict = set()
+            if collect:
+                reachable = self.reachable()
+                evict = set( path for path in files
+                        if path not in reachable or stale( path ) )
+            total -= sum( files[ path ] for path in evict )
+            if cap and total > cap:
+                lru = sorted( ( last.get( path, 0 ), path ) for path in files
+                        if path not in evict and not is_index( path ) )
+                for _, path in lru:
+                    if total <= cap:
+                        break
+                    evict.add( path )
+                    total -= files[ path ]
+
+            for path in evict:
+                os.unlink( self.metap( path ) )
+                base = dirname( path )
+                while base and not os.listdir( self.metap( base ) ):
+                    os.rmdir( self.metap( base ) )
+                    base = dirname( base )
+            self.report.count( "evicted", len( evict ) )
+            self.report.count( "evicted bytes",
+                    sum( files[ path ] for path in evict ) )
+
+            self.cached = set( item for item in self.cached
+                    if item[0] not in evict )
+            self.save( self.USAGE_NAME, { "build": build,
+                "used": dict( (path, n) for path, n in last.items()
+                    if path in files and path not in evict ) } )
+        return evict
+
+    def collect( self ):
+        """Garbage collect the meta store"""
+        self.begin( "Collecting the meta store" )
+        self.gc()
+        self.summarize()
+
+    # Build history
+    def history( self ):
+        """Connection to the build history database"""
+        db = sqlite3.connect( self.metap( self.HISTORY_NAME ) )
+        db.execute( "create table if not exists builds ( started real, "
+                "description text, from_rev text, to_rev text, "
+                "duration real, compiled integer, bytes integer, "
+                "hit_rate real, counts text, stages text )" )
+        return db
+
+    def record_history( self ):
+        """Add the metrics of this build to the history"""
+        report = self.report
+        counts = report.counts
+        lookups = counts.get( "ast hits", 0 ) + counts.get( "parsed", 0 )
+        with contextlib.closing( self.history() ) as db:
+            with db:
+                db.execute( "insert into builds values "
+                        "( ?, ?, ?, ?, ?, ?, ?, ?, ?, ? )", (
+                    report.start, report.description ) + report.revs + (
+                    time.time() - report.start, counts.get( "compiled", 0 ),
+                    counts.get( "bytes written", 0 ),
+                    float( counts.get( "ast hits", 0 ) ) / lookups
+                    if lookups else None,
+                    json.dumps( counts ), json.dumps( report.stages ) ) )
+
+    def stats( self, limit = 30 ):
+        """Print the trend of build times by month, and the last builds,
+        flagging those whose time per compiled file is above the median of
+        the builds before them by the regression factor. Builds are only
+        compared with builds of the same kind and a similar number of
+        compiled files, once there are half a window of them. Returns the
+        regressions."""
+        window = int( self.option( "meta", "stats-window", 10 ) )
+        factor = float( self.option( "meta", "regression", 1.5 ) )
+        with contextlib.closing( self.history() ) as db:
+            rows = db.execute( "select started, description, duration, "
+                    "compiled, bytes, hit_rate from builds "
+                    "order by started" ).fetchall()
+
+        print "Month    Builds  Mean time  Mean hit rate"
+        months = it.groupby( rows, lambda row: time.strftime( "%Y-%m",
+            time.localtime( row[0] ) ) )
+        for month, group in months:
+            group = list( group )
+            rates = [ row[5] for row in group if row[5] is not None ]
+            print "%s  %6d  %8.2fs  %s" % ( month, len( group ),
+                    sum( row[2] for row in group ) / len( group ),
+                    "%12.0f%%" % ( 100 * sum( rates ) / len( rates ) )
+                    if rates else "%13s" % "-" )
+        print
+
+        past = {}
+        lines = []
+        regressions = []
+        for started, description, duration, compiled, written, hit_rate \
+                in rows:
+            # Counts and revs vary between builds of a kind, and the number
+            # of files compiled within a factor of two
+            kind = re.sub( r"\b[0-9a-f]{40}\b|\d+", "#", description or "" )
+            costs = past.setdefault( ( kind, compiled.bit_length() ), [] )
+            cost = duration / max( compiled, 1 )
+            baseline = sorted( costs[-window:] )
+            baseline = baseline[ len( baseline ) // 2 ] \
+                    if len( baseline ) >= max( window // 2, 1 ) else None
+            line = "%s  %-40s %8.2fs  %5d compiled  %s hits  %d bytes" % (
+                    time.strftime( "%Y-%m-%d %H:%M",
+                        time.localtime( started ) ),
+                    description, duration, compiled,
+                    "%3.0f%%" % ( 100 * hit_rate ) if hit_rate is not None
+                    else "   -", written )
+            if baseline and cost > factor * baseline:
+                line += "  REGRESSION (median %.3fs per file)" % baseline
+                regressions.append( ( started, description, cost,
+                    baseline ) )
+            lines.append( line )
+            costs.append( cost )
+        for line in lines[ -limit: ]:
+            print line
+        return regressions
+
+    def finish( self, check_links = False ):
+        """Save the state of this build and summarize it"""
+        # Related pages render pages again, so they go before the delta
+        if self.related is not None:
+            with self.report.stage( "related" ):
+                self.relate()
+        with self.report.stage( "hash" ):
+            self.deploy_delta()
+        self.save( self.MANIFEST_NAME, self.manifest.entries )
+        self.save( self.HASHES_NAME, self.manifest.hashes )
+        self.save( self.VARIABLES_NAME,
+                { "values": self.variables, "uses": self.uses,
+                    "plugins": self.plugins_key, "theme": self.theme_sha or
+                    self.load( self.VARIABLES_NAME, {} ).get( "theme" ) } )
+        self.save( self.FAILED_NAME, sorted( self.failed ) )
+        if self.failed:
+            self.log.warning( "%d files failed to compile: %s",
+                    len( self.failed ), ", ".join( sorted( self.failed ) ) )
+        with self.report.stage( "links" ):
+            self.update_links()
+            if check_links:
+                self.report.count( "broken links",
+                        len( self.check_links() ) )
+        self.record_usage()
+        if int( self.option( "meta", "max-size", 0 ) ):
+            self.gc( collect = False )
+        self.summarize()
+        self.record_history()
+
+    # Sharded builds
+    def build_shard( self, shard, count ):
+        """Render the paths owned by shard (out of count) into outgoing,
+        along with a manifest and the metadata needed for the indexes"""
+        self.begin( "Building shard %d/%d" % (shard, count) )
+
+        self.cache( "theme.html", self.conf.get( "/", "theme" ) )
+
+        pages = {}
+        items = ( (path, binsha) for path, binsha in
+                ChangeSet.walk( self.repo.tree(), self.ignore )
+                if shard_owner( path, count ) == shard )
+        for batch in batches( items, self.BATCH_SIZE ):
+            self.prefetch( Entry( path, binsha ) for path, binsha in batch )
+            for path, binsha in batch:
+                blob = self.blob( path, binsha )
+                self.compile( blob )
+                if not self.ignore_index.match( dirname( path ), True ):
+                    title, created, updated, authors, headers = \
+                            self.extract_meta( blob )
+                    # Times are kept as lists, which json can store
+                    pages[ path ] = [ title, list( created ),
+                            list( updated ), headers.get( "description", "" ) ]
+
+        self.save( self.MANIFEST_NAME, self.manifest.entries )
+        fd = self.outgoing( self.SHARD_NAME, "w" )
+        json.dump( { "rev": self.repo.commit().hexsha,
+            "shard": shard, "count": count,
+            "manifest": dict( (name, self.manifest.entries[ name ])
+                for name in self.manifest.updated ),
+            "pages": pages }, fd )
         fd.close()
-        self.template( self.metap( pjoin(base, "index.md") ) )
-        self.pandoc( self.metap( pjoin(base, "index.md") ), 
-                self.outgoingp( pjoin(base, "index.html") ) ) 
+        self.summarize()
+
+    def merge( self, shard_paths, check_links = False ):
+        """Assemble the outputs of shard builds into outgoing and generate
+        the indexes from their combined metadata"""
+        shards = [ json.load( open( pjoin( path, self.SHARD_NAME ) ) )
+                for path in shard_paths ]
+        revs = set( shard["rev"] for shard in shards )
+        counts = set( shard["count"] for shard in shards )
+        if len( revs ) != 1 or len( counts ) != 1 or sorted(
+                shard["shard"] for shard in shards ) != range( counts.pop() ):
+            raise ValueError( "Shards are incomplete or from different builds" )
+        rev = revs.pop()
+
+        self.begin( "Merging %d shards of %s" % (len( shards ), rev) )
+        self.report.revs = ( None, rev )
+
+        for path, shard in zip( shard_paths, shards ):
+            for name, src in shard["manifest"].items():
+                self.copy( pjoin( path, name ), self.outgoingp( name ) )
+                self.manifest.add( name, src )
+            for src, (title, created, updated, description) in \
+                    shard["pages"].items():
+                self.pages[ src ] = ( title, time.struct_time( created ),
+                        time.struct_time( updated ), description )
+
+        self.cache( "theme.html", self.conf.get( "/", "theme" ) )
+        tree = self.repo.commit( rev ).tree
+        sources = set( path for path, binsha in
+                ChangeSet.walk( tree, self.ignore ) )
+        sources.update( self.build_indexes( tree ) )
+        self.prune( sources )
+
+        self.finish( check_links )
+        self.meta( self.REV_NAME, "w" ).write( rev )
+
+    def build_worktree( self, check_links = False ):
+        """Build the working tree, including uncommitted changes. Indexes
+        are regenerated from HEAD for the directories touched."""
+        self.begin( "Building working tree" )
+
+        modifys, deletes, stats = self.worktree_changes()
+
+        theme = self.conf.get( "/", "theme" )
+        self.cache( "theme.html", self.worktree_blob( theme ) )
+        if self.theme_changed():
+            modifys = list( self.worktree_paths() )
+
+        for path in modifys:
+            self.compile( self.worktree_blob( path ) )
+        for path in deletes:
+            self.delete( self.worktree_blob( path ) )
+
+        tree = self.repo.tree()
+        for base in set( dirname( path ) for path in modifys + deletes ):
+            t = tree if base == "" else self.find( tree, base )
+            if t is not None:
+                self.build_index( t )
+
+        self.save( self.STAT_NAME, stats )
+        self.finish( check_links )
+
+    def retry_failed( self, check_links = False ):
+        """Compile again only the files that failed in previous builds"""
+        self.begin( "Retrying %d failed files" % len( self.failed ) )
+
+        rev = self.current_rev()
+        tree = self.repo.commit( rev ).tree if rev else self.repo.tree()
+        entries = []
+        for path in sorted( self.failed ):
+            blob = self.find( tree, path )
+            if blob is None:
+                self.failed.discard( path )
+            else:
+                entries.append( Entry.from_blob( blob ) )
+
+        self.cache( "theme.html", self.conf.get( "/", "theme" ) )
+        self.prefetch( entries )
+        for entry in entries:
+            self.compile( entry.blob( self.repo ) )
+        self.finish( check_links )
+
+    def publish( self, target ):
+        """Copy the files changed since the last publish of outgoing to
+        target, and delete the ones removed. Target keeps the hashes of
+        what it holds, so builds can be published in any batches."""
+        self.begin( "Publishing to %s" % target )
+        state = pjoin( target, self.PUBLISHED_NAME )
+        published = json.load( open( state ) ) if pexists( state ) else {}
+        delta = self.manifest.delta( published )
+
+        with self.report.stage( "publish" ):
+            for name, digest in sorted( delta[ "uploaded" ].items() ):
+                dst = pjoin( target, name )
+                if not pexists( dirname( dst ) ):
+                    os.makedirs( dirname( dst ) )
+                shutil.copyfile( self.outgoingp( name ), dst + ".tmp" )
+                os.rename( dst + ".tmp", dst )
+                published[ name ] = digest
+                self.log.debug( "Uploaded %s", name )
+            for name in delta[ "deleted" ]:
+                if pexists( pjoin( target, name ) ):
+                    os.unlink( pjoin( target, name ) )
+                published.pop( name )
+                self.log.debug( "Deleted %s", name )
+
+            fd = open( state + ".tmp", "w" )
+            json.dump( published, fd )
+            fd.close()
+            os.rename( state + ".tmp", state )
+
+        for key in ( "uploaded", "deleted", "unchanged" ):
+            self.report.count( key, len( delta[ key ] ) )
+        self.summarize()
+        return delta
+
+    def verify_file( self, item ):
+        """Check a (name, hash) manifest item against outgoing; returns the
+        name and None, missing or modified"""
+        name, digest = item
+        path = self.outgoingp( name )
+        if not pexists( path ):
+            return name, "missing"
+        if git_hash( path ) != digest:
+            return name, "modified"
+        return name, None
+
+    def verify( self ):
+        """Check in parallel that outgoing holds the files in the manifest,
+        with the hashes they were published with"""
+        self.begin( "Verifying %d files" % len( self.manifest.hashes ) )
+        problems = []
+        with self.report.stage( "verify" ):
+            for name, problem in self.workers.pool.imap_unordered(
+                    self.verify_file, self.manifest.hashes.items() ):
+                self.report.count( "verified" )
+                if problem is not None:
+                    self.log.warning( "%s is %s", name, problem )
+                    print "%s: %s" % (name, problem)
+                    self.report.count( problem )
+                    problems.append( ( name, problem ) )
+        self.summarize()
+        return sorted( problems )
+
+    # Lazy rendering server
+    def source( self, path, ref = None ):
+        """Blob of the file at path in ref, or the working tree if ref is
+        None, and the hash of its contents; (None, None) if there is none"""
+        if ref is None:
+            root = os.path.realpath( self.repo.working_tree_dir )
+            abspath = pjoin( root, path )
+            # Nothing outside the working tree, even through symlinks
+            if not os.path.realpath( abspath ).startswith( root + os.sep ) \
+                    or not os.path.isfile( abspath ):
+                return None, None
+            return self.worktree_blob( path ), git_hash( abspath )
+        blob = self.find( self.repo.commit( ref ).tree, path )
+        if blob is None or blob.type != "blob":
+            return None, None
+        return blob, blob.hexsha
+
+    def page_key( self, *sources ):
+        """Key of the page rendered from sources, with the plugins and
+        variables of this process"""
+        variables = json.dumps( sorted( self.variables.items() ) )
+        return hashlib.sha1( "\0".join( sources + ( self.plugins_key,
+            variables ) ) ).hexdigest()
+
+    def page( self, key, name ):
+        """Keep the file rendered at name as the page for key"""
+        page = self.metap( pjoin( "pages", key[:2], key ) )
+        if not pexists( dirname( page ) ):
+            os.makedirs( dirname( page ) )
+        shutil.copyfile( self.outgoingp( name ), tmpname( page ) )
+        os.rename( tmpname( page ), page )
+        return page
+
+    def lookup( self, name, ref = None ):
+        """Path of the page published at name, rendered from ref or the
+        working tree. Pages are kept by the hash of their sources, so a page
+        is only rendered on its first request after a change. Returns None
+        if nothing is published at name."""
+        theme, theme_sha = self.source( self.conf.get( "/", "theme" ), ref )
+        if theme_sha != self.theme_sha:
+            self.cache( "theme.html", theme )
+            self.theme_sha = theme_sha
+
+        for src in ( os.path.splitext( name )[0] + PANDOC_EXTN, name ):
+            if target_name( src ) != name or self.ignore.match( src ):
+                continue
+            blob, sha = self.source( src, ref )
+            if blob is not None:
+                break
+        else:
+            return self.lookup_index( name, ref )
+
+        key = self.page_key( src, sha, theme_sha )
+        page = self.metap( pjoin( "pages", key[:2], key ) )
+        if pexists( page ):
+            self.report.count( "cached" )
+            return page
+        if not self.compile( blob ):
+            raise ValueError( "Error compiling %s" % src )
+        return self.page( key, name )
+
+    def lookup_index( self, name, ref = None ):
+        """Path of the generated index page published at name, or None"""
+        match = re.match( r"^(?:(.*)/)?(?:index|page/\d+)\.html$", name )
+        if match is None:
+            return None
+        base = match.group( 1 ) or ""
+        # Like working tree builds, indexes list the files in HEAD
+        tree = self.repo.commit( ref or "HEAD" ).tree
+        if base:
+            tree = self.find( tree, base )
+        if tree is None or tree.type != "tree" or \
+                self.ignore.match( base, True ):
+            return None
 
-        # If no existing index, build an index
-        logging.info( "Updating index for %s", base )
+        key = self.page_key( name, tree.hexsha, self.theme_sha )
+        page = self.metap( pjoin( "pages", key[:2], key ) )
+        if pexists( page ):
+            self.report.count( "cached" )
+            return page
+        self.journal = Journal()
+        self.build_index( tree )
+        if not pexists( self.outgoingp( name ) ):
+            return None
+        return self.page( key, name )
+
+    def serve( self, port, ref = None ):
+        """Serve the site on port, rendering each page from ref, or the
+        working tree, when it is first requested"""
+        import BaseHTTPServer
+
+        gen = self
+        root = urlparse.urlsplit( self.variables.get( "urlroot", "" ) ).path
+        root = root.rstrip( "/" )
+
+        class Handler( BaseHTTPServer.BaseHTTPRequestHandler ):
+            """Answers GET requests with gen.lookup"""
+            def do_GET( self ):
+                name = urllib.unquote( self.path.split( "?" )[0] )
+                if root and name.startswith( root ):
+                    name = name[ len( root ): ]
+                index = name.endswith( "/" )
+                parts = [ part for part in name.split( "/" )
+                        if part not in ( "", "." ) ]
+                if ".." in parts:
+                    self.send_error( 404 )
+                    return
+                name = "/".join( parts + ( [ "index.html" ] if index or
+                    not parts else [] ) )
+                try:
+                    path = gen.lookup( name, ref )
+                except Exception:
+                    gen.log.exception( "Error serving %s", name )
+                    self.send_error( 500 )
+                    return
+                if path is None:
+                    self.send_error( 404 )
+                    return
+                self.send_response( 200 )
+                self.send_header( "Content-Type", mimetypes.guess_type(
+                    name )[0] or "application/octet-stream" )
+                self.send_header( "Content-Length",
+                        str( os.path.getsize( path ) ) )
+                self.end_headers()
+                fd = open( path, "rb" )
+                shutil.copyfileobj( fd, self.wfile )
+                fd.close()
+
+            def log_message( self, fmt, *args ):
+                gen.log.debug( fmt, *args )
+
+        self.theme_sha = None
+        server = BaseHTTPServer.HTTPServer( ( "localhost", port ), Handler )
+        print "Serving %s on http://localhost:%d%s/" % (
+                ref or "the working tree", port, root )
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        server.server_close()
 
     # Entry point
-    def build(self, from_rev, to_rev, incremental = False):
+    def build(self, from_rev, to_rev, incremental = False,
+            check_links = False):
         """Build the site to head_rev"""
 
-        print "Building (incremental=%s)..."% str(incremental)
-        logging.info( "Build initiated with incremental = %s",
-                str(incremental) )
+        self.begin( "Building (incremental=%s)" % str(incremental) )
+
+        # Everything is built from the tree of to_rev, which need not be
+        # HEAD, e.g. for previews
+        to_rev = self.repo.commit( to_rev ).hexsha
+        tree = self.repo.commit( to_rev ).tree
+        self.rev = to_rev
 
         if from_rev is None:
             from_rev = self.current_rev()
         if from_rev is None or not incremental:
-            cs = ChangeSet.from_repo( self.repo )
+            # Full builds stream the tree instead
+            cs = None
         else:
-            cs = self.changes( from_rev, to_rev ) 
-
-        # Check if the theme has been modified
-        theme = self.conf.get( "/", "theme" )
-        if cs.exists( theme ):
-            # Oh noes, theme has been changed recompile
-            cs = ChangeSet.from_repo( self.repo )
-
+            with self.report.stage( "diff" ):
+                cs = self.changes( from_rev, to_rev ) 
+            # Files that failed last time, or use a variable that changed,
+            # need compiling again
+            for path in self.affected() | self.failed:
+                blob = self.find( tree, path )
+                if blob is not None:
+                    cs.modifys.add( Entry.from_blob( blob ) )
+
+        # Resume the work of an interrupted build between the same revs
+        self.report.revs = ( None if cs is None else
+                self.repo.commit( from_rev ).hexsha, to_rev )
+        self.journal = Journal( self.metap( self.JOURNAL_NAME ), "%s %s" % (
+            "full" if cs is None else self.repo.commit( from_rev ).hexsha,
+            to_rev ) )
+        if len( self.journal ):
+            self.log.info( "Resuming after %d finished items",
+                    len( self.journal ) )
+            self.report.count( "resumed", len( self.journal ) )
+
+        theme = tree[ self.conf.get( "/", "theme" ) ]
         self.cache( "theme.html", theme )
+        rethemed = self.theme_changed()
 
-        # Apply recursively from the root
-        self.apply( self.repo.tree(), cs )
-
-        save_rev = self.repo.commit().hexsha if to_rev == None else to_rev
-        self.meta( self.REV_NAME, "w" ).write( save_rev )
-
-def main( conf_path, from_rev, to_rev, incremental = False ):
-    """Sitegen entry point"""
-
-    gen = SiteGenerator( conf_path )
-    gen.build( from_rev, to_rev, incremental )
+        if cs is None:
+            self.compile_all( tree )
+        else:
+            # Apply recursively from the root
+            self.prefetch( cs.modifys )
+            self.apply( tree, cs )
+
+            # Check if the theme or plugins have been modified; only the
+            # writer needs to run again on the remaining pages
+            plugins = self.load( self.VARIABLES_NAME, {} ).get( "plugins", "" )
+            if rethemed or plugins != self.plugins_key:
+                self.retheme( tree, cs )
+
+        self.finish( check_links )
+
+        self.meta( self.REV_NAME, "w" ).write( to_rev )
+        self.journal.discard()
+
+def seed_preview( meta_path, outgoing_path, preview_meta, preview_outgoing ):
+    """Start a preview from the state and output of the main build, so that
+    its first build only renders what differs from it"""
+    names = [ name for name in SiteGenerator.SEED_NAMES
+            if pexists( pjoin( meta_path, name ) ) ]
+    indexes = pjoin( meta_path, SiteGenerator.INDEXES_NAME )
+    for dirpath, dirnames, filenames in os.walk( indexes ):
+        names += [ os.path.relpath( pjoin( dirpath, fn ), meta_path )
+                for fn in filenames if fn == "index.json" ]
+    for name in names:
+        dst = pjoin( preview_meta, name )
+        if not pexists( dirname( dst ) ):
+            os.makedirs( dirname( dst ) )
+        shutil.copyfile( pjoin( meta_path, name ), dst )
+
+    manifest = pjoin( meta_path, SiteGenerator.MANIFEST_NAME )
+    names = json.load( open( manifest ) ) if pexists( manifest ) else {}
+    for name in names:
+        if pexists( pjoin( outgoing_path, name ) ):
+            dst = pjoin( preview_outgoing, name )
+            if not pexists( dirname( dst ) ):
+                os.makedirs( dirname( dst ) )
+            shutil.copyfile( pjoin( outgoing_path, name ), dst )
+
+def build_site( conf_path, from_rev, to_rev, incremental = False,
+        check_links = False, worktree = False, shard = None, merge = None,
+        outgoing_path = None, verbose = False, retry_failed = False,
+        publish = None, verify = False, gc = False, stats = False,
+        preview = None, serve = None, workers = None, shared_path = None ):
+    """Run the command for the site configured in conf_path"""
+    conf = CP.ConfigParser()
+    conf.read( conf_path )
+    meta_path = conf.get( "paths", "meta" )
+
+    if shard is not None:
+        # Each shard keeps its own meta-store, so they can share a conf
+        shard, count = map( int, shard.split( "/" ) )
+        if not 0 <= shard < count:
+            raise ValueError( "Shard must be k/N with 0 <= k < N" )
+        meta_path = pjoin( meta_path, "shard-%d-of-%d" % (shard, count) )
+        with locked( pjoin( meta_path, SiteGenerator.LOCK_NAME ) ):
+            gen = SiteGenerator( conf_path, outgoing_path, meta_path,
+                    verbose, workers = workers )
+            gen.build_shard( shard, count )
+        return
+
+    if preview is not None:
+        # Each preview keeps its own state, but shares the ASTs and plugin
+        # outputs of the main store; several previews can build at once
+        preview_meta = pjoin( meta_path, SiteGenerator.PREVIEWS_NAME,
+                re.sub( r"[^\w.-]", "_", preview ) )
+        outgoing_path = outgoing_path or pjoin( preview_meta, "site" )
+        with locked( pjoin( preview_meta, SiteGenerator.LOCK_NAME ) ):
+            if not pexists( pjoin( preview_meta, SiteGenerator.REV_NAME ) ):
+                with locked( pjoin( meta_path, SiteGenerator.LOCK_NAME ),
+                        False ):
+                    seed_preview( meta_path, conf.get( "paths", "outgoing" ),
+                            preview_meta, outgoing_path )
+            with locked( pjoin( meta_path, SiteGenerator.SHARED_LOCK_NAME ),
+                    False ):
+                gen = SiteGenerator( conf_path, outgoing_path, preview_meta,
+                        verbose, meta_path, workers )
+                gen.build( None, preview, True, check_links )
+        return
+
+    if worktree:
+        # Uncommitted changes are built apart from the commits, so that they
+        # never reach the outgoing, manifest or deploy state of the site
+        worktree_meta = pjoin( meta_path, SiteGenerator.WORKTREE_NAME )
+        with locked( pjoin( worktree_meta, SiteGenerator.LOCK_NAME ) ):
+            with locked( pjoin( shared_path or meta_path,
+                    SiteGenerator.SHARED_LOCK_NAME ), False ):
+                gen = SiteGenerator( conf_path, outgoing_path or
+                        pjoin( worktree_meta, "site" ), worktree_meta, verbose,
+                        shared_path or meta_path, workers )
+                gen.build_worktree( check_links )
+        return
+
+    if serve is not None:
+        # The server keeps its pages and index state apart from the builds
+        serve_meta = pjoin( meta_path, SiteGenerator.SERVE_NAME )
+        with locked( pjoin( serve_meta, SiteGenerator.LOCK_NAME ) ):
+            gen = SiteGenerator( conf_path, outgoing_path or
+                    pjoin( serve_meta, "site" ), serve_meta, verbose,
+                    meta_path, workers )
+            gen.serve( serve, to_rev )
+        return
+
+    # Read-only commands can run alongside a build
+    with locked( pjoin( meta_path, SiteGenerator.LOCK_NAME ),
+            not ( stats or verify ) ):
+        gen = SiteGenerator( conf_path, outgoing_path, verbose = verbose,
+                shared_path = shared_path, workers = workers )
+        if stats:
+            gen.stats()
+        elif gc:
+            gen.collect()
+        elif verify:
+            if gen.verify():
+                raise SystemExit( 1 )
+        elif publish:
+            gen.publish( publish )
+        elif merge:
+            gen.merge( merge, check_links )
+        elif retry_failed:
+            gen.retry_failed( check_links )
+        else:
+            gen.build( from_rev, to_rev, incremental, check_links )
+
+def main( conf_paths, from_rev, to_rev, incremental = False,
+        check_links = False, worktree = False, shard = None, merge = None,
+        outgoing_path = None, verbose = False, retry_failed = False,
+        publish = None, verify = False, gc = False, stats = False,
+        preview = None, jobs = None, serve = None ):
+    """Sitegen entry point. Several sites are built at once, sharing one
+    pool of workers and the ASTs and plugin outputs of the first site."""
+    workers = Workers( jobs or mp.cpu_count() )
+    args = ( from_rev, to_rev, incremental, check_links, worktree, shard,
+            merge, outgoing_path, verbose, retry_failed, publish, verify,
+            gc, stats, preview, serve, workers )
+    if len( conf_paths ) == 1:
+        build_site( conf_paths[0], *args )
+        return
+    if shard is not None or preview is not None or serve is not None or \
+            merge or publish or outgoing_path:
+        raise ValueError( "Shards, previews, serving, merges, publishing "
+                "and -o need a single --conf" )
+
+    conf = CP.ConfigParser()
+    conf.read( conf_paths[0] )
+    shared_path = conf.get( "paths", "meta" )
+    failed = []
+    def run( conf_path, shared ):
+        try:
+            if shared is None:
+                build_site( conf_path, *args )
+            else:
+                # Keep gc of the first site off the shared files
+                with locked( pjoin( shared, SiteGenerator.SHARED_LOCK_NAME ),
+                        False ):
+                    build_site( conf_path, *args, shared_path = shared )
+        except ( Exception, SystemExit ):
+            logging.exception( "Building %s failed", conf_path )
+            failed.append( conf_path )
+
+    threads = [ threading.Thread( target = run, args = ( conf_path,
+        shared_path if i else None ) )
+        for i, conf_path in enumerate( conf_paths ) ]
+    for thread_ in threads:
+        thread_.start()
+    for thread_ in threads:
+        thread_.join()
+    if failed:
+        raise SystemExit( "Failed: %s" % ", ".join( failed ) )
 
 if __name__ == "__main__":
     import argparse
 
     PARSER = argparse.ArgumentParser( description = "Static site generator" )
-    PARSER.add_argument( "--conf", dest="conf", default="website.conf",
-            help="Path to configuration file" ) 
+    PARSER.add_argument( "--conf", dest="conf", nargs="+",
+            default=[ "website.conf" ],
+            help="Paths to configuration files; several sites are built at "
+            "once" ) 
     PARSER.add_argument( "-i", dest="incremental", action='store_true',
             default=False, help="Incrementally generate files" ) 
     PARSER.add_argument( "-f", dest="from_rev",
             default=None, help="Recompile from this rev. Needs -i" ) 
     PARSER.add_argument( "-t", dest="to_rev",
             default=None, help="Recompile to this rev, from current. Needs -i" ) 
+    PARSER.add_argument( "-l", dest="check_links", action='store_true',
+            default=False, help="Report links that do not resolve" ) 
+    PARSER.add_argument( "-w", dest="worktree", action='store_true',
+            default=False, help="Build the working tree, with uncommitted changes, "
+            "into -o or the working tree's meta store" ) 
+    PARSER.add_argument( "--shard", dest="shard", default=None,
+            help="Render only shard k/N (0 <= k < N) of a full build" ) 
+    PARSER.add_argument( "--merge", dest="merge", nargs="+", default=None,
+            help="Assemble the site from these shard outputs" ) 
+    PARSER.add_argument( "-o", dest="outgoing", default=None,
+            help="Output to this directory instead of the configured one" ) 
+    PARSER.add_argument( "-v", dest="verbose", action='store_true',
+            default=False, help="Log every file processed" ) 
+    PARSER.add_argument( "--retry-failed", dest="retry_failed",
+            action='store_true', default=False,
+            help="Only compile the files that failed in previous builds" ) 
+    PARSER.add_argument( "--publish", dest="publish", default=None,
+            help="Copy the changes to outgoing since the last publish to "
+            "this directory" ) 
+    PARSER.add_argument( "--verify", dest="verify", action='store_true',
+            default=False, help="Check outgoing against the manifest" ) 
+    PARSER.add_argument( "--gc", dest="gc", action='store_true',
+            default=False, help="Evict stale files from the meta store" ) 
+    PARSER.add_argument( "--stats", dest="stats", action='store_true',
+            default=False, help="Show build times and flag regressions" ) 
+    PARSER.add_argument( "--preview", dest="preview", default=None,
+            help="Build this ref as a preview, into -o or the preview's "
+            "meta store" ) 
+    PARSER.add_argument( "-j", dest="jobs", type=int, default=None,
+            help="Run at most this many pandoc processes at once, across "
+            "all sites (default: number of CPUs)" ) 
+    PARSER.add_argument( "--serve", dest="serve", type=int, default=None,
+            help="Serve the site on this port, rendering pages as they are "
+            "requested from -t or the working tree" ) 
     ARGS = PARSER.parse_args()
 
-    main( ARGS.conf, ARGS.from_rev, ARGS.to_rev, ARGS.incremental )
+    main( ARGS.conf, ARGS.from_rev, ARGS.to_rev, ARGS.incremental,
+            ARGS.check_links, ARGS.worktree, ARGS.shard, ARGS.merge,
+            ARGS.outgoing, ARGS.verbose, ARGS.retry_failed, ARGS.publish,
+            ARGS.verify, ARGS.gc, ARGS.stats, ARGS.preview, ARGS.jobs,
+            ARGS.serve )
 
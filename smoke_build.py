@@ -0,0 +1,189 @@
+#!/usr/bin/env python2
+"""
+Smoke test of sitegen.py: builds a small site from a temporary git repo
+through the command line, and checks the pages it publishes. Needs git and
+pandoc.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import subprocess as sp
+from os.path import join as pjoin
+
+SITEGEN = os.path.join( os.path.dirname( os.path.abspath( __file__ ) ),
+        "sitegen.py" )
+THEME = "<html><title>$title$</title><base href=\"${urlroot}/\">\n" \
+        "$body$\n</html>\n"
+CONF = """[paths]
+incoming = %(root)s/repo
+outgoing = %(root)s/out
+meta = %(root)s/meta
+
+[variables]
+urlroot = /site
+
+[/]
+theme = theme.html
+ignore = theme.html
+archive = yes
+"""
+POST = "%% Post %d\n%% Author\n%% Jan 0%d 2014\n%% Description: Summary %d\n" \
+        "%% Tags: a, b\n\nText %d\n"
+
+class Site:
+    """A git repo with a site in it, and the conf to build it"""
+    def __init__( self, root ):
+        self.root = root
+        self.repo = pjoin( root, "repo" )
+        self.devnull = open( os.devnull, "w" )
+        os.makedirs( self.repo )
+        self.git( "init", "-q" )
+        self.git( "config", "user.email", "smoke@example.com" )
+        self.git( "config", "user.name", "Smoke" )
+        open( pjoin( root, "website.conf" ), "w" ).write(
+                CONF % { "root": root } )
+
+    def git( self, *args ):
+        sp.check_call( [ "git" ] + list( args ), cwd = self.repo,
+                stdout = self.devnull )
+
+    def write( self, path, text ):
+        path = pjoin( self.repo, path )
+        if not os.path.exists( os.path.dirname( path ) ):
+            os.makedirs( os.path.dirname( path ) )
+        open( path, "w" ).write( text )
+
+    def commit( self, message ):
+        self.git( "add", "-A" )
+        self.git( "commit", "-q", "-m", message )
+
+    def sitegen( self, *args ):
+        """Run sitegen on the site; returns its exit status"""
+        return sp.call( [ sys.executable, SITEGEN, "--conf",
+            pjoin( self.root, "website.conf" ) ] + list( args ),
+            cwd = self.root, stdout = self.devnull )
+
+    def read( self, path ):
+        """Contents of a published file, or None"""
+        path = pjoin( self.root, path )
+        return open( path ).read() if os.path.exists( path ) else None
+
+def main( keep ):
+    """Smoke test entry point; returns the exit status"""
+    root = tempfile.mkdtemp( prefix = "sitegen-smoke-" )
+    failures = []
+    def check( ok, message ):
+        print "%s: %s" % ( "ok" if ok else "FAIL", message )
+        if not ok:
+            failures.append( message )
+
+    try:
+        site = Site( root )
+        site.write( "theme.html", THEME )
+        site.write( "about.md", "% About\n\nAbout $urlroot$.\n" )
+        for i in range( 1, 4 ):
+            site.write( "blog/p%d.md" % i, POST % ( i, i, i, i ) )
+        # Repo files named like the build state are content like any other
+        site.write( "data/index.json", "[1, 2]\n" )
+        site.write( "manifest.json", "[]\n" )
+        site.commit( "Add posts" )
+
+        check( site.sitegen() == 0, "full build" )
+        check( site.read( "out/blog/p1.html" ) is not None, "page published" )
+        index = site.read( "out/blog/index.html" ) or ""
+        check( "Post 3" in index and "Post 1" in index, "index generated" )
+        check( site.read( "out/blog/2014/01/index.html" ) is not None,
+                "archive generated" )
+        check( site.sitegen( "--publish", pjoin( root, "published" ) ) == 0
+                and site.read( "published/blog/p1.html" ) is not None,
+                "publish" )
+
+        site.write( "blog/p4.md", POST % ( 4, 4, 4, 4 ) )
+        site.commit( "Add a post" )
+        check( site.sitegen( "-i" ) == 0, "incremental build" )
+        index = site.read( "out/blog/index.html" ) or ""
+        check( "Post 4" in index and "Summary 4" in index, "index updated" )
+        check( site.read( "out/data/index.json" ) == "[1, 2]\n",
+                "data files published" )
+
+        # The theme is ignored, but changing it renders every page again
+        site.write( "theme.html", THEME.replace( "<html>", "<html>v2" ) )
+        site.commit( "New theme" )
+        check( site.sitegen( "-i" ) == 0, "incremental build of a theme" )
+        check( "v2" in ( site.read( "out/blog/p2.html" ) or "" ) and
+                "v2" in ( site.read( "out/blog/index.html" ) or "" ),
+                "pages use the new theme" )
+        check( site.sitegen( "--verify" ) == 0, "outgoing matches manifest" )
+        check( site.sitegen( "--publish", pjoin( root, "published" ) ) == 0
+                and "v2" in ( site.read( "published/blog/p2.html" ) or "" ),
+                "publish the new theme" )
+
+        # So do the variables the theme uses
+        conf = site.read( "website.conf" )
+        open( pjoin( root, "website.conf" ), "w" ).write(
+                conf.replace( "urlroot = /site", "urlroot = /v2" ) )
+        check( site.sitegen( "-i" ) == 0, "incremental build of a variable" )
+        check( '"/v2/"' in ( site.read( "out/blog/p2.html" ) or "" ),
+                "pages use the new variable" )
+        site.write( "theme.html", THEME.replace( "<html>", "<html>v3" ) )
+        check( site.sitegen( "-w" ) == 0, "working tree build of a theme" )
+        check( "v3" in ( site.read( "meta/worktree/site/blog/p2.html" )
+            or "" ), "pages use the working tree theme" )
+        check( "v3" not in ( site.read( "out/blog/p2.html" ) or "" ) and
+                site.sitegen( "--verify" ) == 0,
+                "working tree build leaves outgoing alone" )
+        site.git( "checkout", "theme.html" )
+
+        # A preview of a branch only renders what differs from the main build
+        site.git( "checkout", "-q", "-b", "topic" )
+        site.write( "notes/n1.md", "% Note\n\nA note.\n" )
+        site.commit( "Add notes" )
+        site.git( "checkout", "-q", "-" )
+        check( site.sitegen( "--preview", "topic", "-o",
+            pjoin( root, "preview" ) ) == 0, "preview build" )
+        check( site.read( "preview/notes/n1.html" ) is not None and
+                site.read( "preview/notes/index.html" ) is not None and
+                site.read( "preview/blog/p1.html" ) is not None,
+                "preview has the branch" )
+        check( site.read( "out/notes/n1.html" ) is None,
+                "preview leaves the main build alone" )
+
+        # Full builds remove what was deleted since the last build
+        site.git( "rm", "-q", "about.md" )
+        site.commit( "Remove about" )
+        check( site.sitegen() == 0 and site.read( "out/about.html" ) is None,
+                "full build of a deletion" )
+        check( site.sitegen( "--publish", pjoin( root, "published" ) ) == 0
+                and site.read( "published/about.html" ) is None,
+                "publish a deletion" )
+
+        for shard in range( 2 ):
+            check( site.sitegen( "--shard", "%d/2" % shard, "-o",
+                pjoin( root, "shard%d" % shard ) ) == 0, "shard %d/2" % shard )
+        check( site.sitegen( "--merge", pjoin( root, "shard0" ),
+            pjoin( root, "shard1" ), "-o", pjoin( root, "merged" ) ) == 0,
+            "merge shards" )
+        index = site.read( "merged/blog/index.html" ) or ""
+        check( "Post 4" in index and "Summary 4" in index and
+                site.read( "merged/blog/p2.html" ) is not None,
+                "merged site" )
+    finally:
+        if keep:
+            print "Kept %s" % root
+        else:
+            shutil.rmtree( root )
+
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    import argparse
+
+    PARSER = argparse.ArgumentParser( description =
+            "Build a small site with sitegen and check the result" )
+    PARSER.add_argument( "-k", dest="keep", action='store_true',
+            default=False, help="Keep the temporary site for inspection" )
+    ARGS = PARSER.parse_args()
+
+    sys.exit( main( ARGS.keep ) )